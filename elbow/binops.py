@@ -4,7 +4,7 @@ import tensorflow as tf
 
 import util
 
-from conditional_dist import ConditionalDistribution
+from conditional_dist import ConditionalDistribution, _remember, _replace
 from transforms import DeterministicTransform
 
 
@@ -92,6 +92,23 @@ class CombinedDistribution(ConditionalDistribution):
         self.inputs_nonrandom = inputs_nonrandom
         return {}
 
+    def _redraw(self, saved):
+        self.A._redraw(saved)
+        self.B._redraw(saved)
+        _remember(self, ["_sampled", "_sampled_entropy"], saved)
+        sample, entropy = self._sample_and_entropy()
+        _replace(self, {"_sampled": sample, "_sampled_entropy": entropy}, saved)
+
+    def _rebind_parameters(self, rebuild, saved):
+        self.A._rebind_parameters(rebuild, saved)
+        self.B._rebind_parameters(rebuild, saved)
+        inputs_nonrandom = {}
+        for (k, v) in self.A.inputs_nonrandom.items():
+            inputs_nonrandom["A_" + k] = v
+        for (k, v) in self.B.inputs_nonrandom.items():
+            inputs_nonrandom["B_" + k] = v
+        _replace(self, {"inputs_nonrandom": inputs_nonrandom}, saved)
+        
     def _sample_and_entropy(self, **kwargs):
         a = self.A._sampled
         b = self.B._sampled
@@ -0,0 +1,173 @@
+from __future__ import print_function
+import numpy as np
+import tensorflow as tf
+
+import os
+import time
+import threading
+
+try:
+    # unlike os.rename, this overwrites an existing file on Windows too
+    from os import replace as replace_file
+except ImportError: # python 2
+    from os import rename as replace_file
+
+"""
+Saving and restoring the variational parameters of a Model, keyed by
+node name so that a checkpoint can be loaded into a freshly rebuilt
+model (whose TF variable names will generally differ). 
+"""
+
+VARIABLE_OP_TYPES = ("Variable", "VariableV2", "VarHandleOp")
+
+def input_variables(tensor):
+    """
+    Return the TF Variables that a tensor (or each of a list of 
+    tensors) is computed from, in a deterministic (depth-first) order. 
+    """
+    tensors = tensor if isinstance(tensor, (list, tuple)) else [tensor,]
+    if len(tensors) == 0:
+        return []
+    graph = tensors[0].graph
+    var_by_op = {v.op: v for v in graph.get_collection(tf.GraphKeys.GLOBAL_VARIABLES)}
+    
+    found = []
+    visited = set()
+    stack = list(reversed([t.op for t in tensors]))
+    while stack:
+        op = stack.pop()
+        if op in visited:
+            continue
+        visited.add(op)
+        if op.type in VARIABLE_OP_TYPES:
+            if op in var_by_op:
+                found.append(var_by_op[op])
+            continue
+        stack.extend(reversed([t.op for t in op.inputs]))
+    return found
+
+def variational_variables(model):
+    """
+    Map a key "<node name>/<input name>/<i>" to each Variable underlying 
+    the nonrandom inputs of the model's variational nodes. 
+    """
+    variables = {}
+    for node in model.get_variational_nodes():
+        for input_name, tensor in sorted(node.inputs_nonrandom.items()):
+            for i, v in enumerate(input_variables(tensor)):
+                variables["%s/%s/%d" % (node.name, input_name, i)] = v
+    return variables
+
+def variational_values(model):
+    """
+    Fetch the current values of a model's variational parameters, as
+    a dict keyed like variational_variables. 
+    """
+    variables = variational_variables(model)
+    keys = sorted(variables.keys())
+    vals = model.session.run([variables[k] for k in keys])
+    return dict(zip(keys, vals))
+
+def write_checkpoint(path, values):
+    # write to a temporary file and rename, so a crash mid-write
+    # never leaves a truncated checkpoint behind. 
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, **values)
+    replace_file(tmp_path, path)
+    
+class CheckpointWriter(object):
+    """
+    Fetches a model's variational parameters and writes them to disk
+    on a background thread, so training can continue while the file
+    is written. At most one write is in flight at a time. 
+
+    If every_steps and/or every_s are given, calling step() after each 
+    optimizer step saves a checkpoint whenever either interval has 
+    elapsed since the last one. 
+    """
+    
+    def __init__(self, model, path, every_steps=None, every_s=None):
+        self.model = model
+        self.path = path
+        self.every_steps = every_steps
+        self.every_s = every_s
+        
+        self.variables = None
+        self.thread = None
+
+        self.steps_since = 0
+        self.last_t = time.time()
+
+    def step(self, n_steps=1):
+        self.steps_since += n_steps
+        due = (self.every_steps is not None and self.steps_since >= self.every_steps) or \
+              (self.every_s is not None and time.time() - self.last_t >= self.every_s)
+        if due and self.save():
+            self.steps_since = 0
+            self.last_t = time.time()
+
+    def save(self, block=False):
+        if self.thread is not None and self.thread.is_alive():
+            if not block:
+                # still writing the previous checkpoint; skip this one
+                return False
+            self.thread.join()
+
+        if self.variables is None:
+            self.variables = variational_variables(self.model)
+        keys = sorted(self.variables.keys())
+        vals = self.model.session.run([self.variables[k] for k in keys])
+        values = dict(zip(keys, vals))
+        
+        self.thread = threading.Thread(target=write_checkpoint, args=(self.path, values))
+        self.thread.start()
+        if block:
+            self.thread.join()
+        return True
+
+def restore_checkpoint(model, path, verbose=True):
+    """
+    Load the variational parameters saved at path into model. See
+    load_variational_values. 
+    """
+    with np.load(path) as saved:
+        return load_variational_values(model, saved, verbose=verbose)
+
+def load_variational_values(model, saved, verbose=True):
+    """
+    Load variational parameters (a dict or npz file, keyed like 
+    variational_variables) into model, matching by node name. Keys
+    the model doesn't have are ignored. If a saved array is smaller 
+    than the current variable along some dimensions and no larger along
+    any (e.g., a factor matrix that gained rows), we copy the saved 
+    values into the leading block and keep the current initialization
+    elsewhere. Arrays of any other shape are skipped, since we can't
+    tell which of their values would belong where. Returns the list of
+    restored keys. 
+    """
+    variables = variational_variables(model)
+    session = model.session
+    
+    restored = []
+    for key, v in sorted(variables.items()):
+        if key not in saved:
+            continue
+        saved_val = saved[key]
+        current_shape = tuple(v.get_shape().as_list())
+        if saved_val.shape == current_shape:
+            v.load(saved_val, session)
+        elif len(saved_val.shape) == len(current_shape) and \
+             all(a <= b for (a, b) in zip(saved_val.shape, current_shape)):
+            val = session.run(v)
+            block = tuple(slice(0, a) for a in saved_val.shape)
+            val[block] = saved_val
+            v.load(val, session)
+            if verbose:
+                print("partially restored %s: saved shape %s, current shape %s" % (key, saved_val.shape, current_shape))
+        else:
+            if verbose:
+                print("not restoring %s: saved shape %s incompatible with %s" % (key, saved_val.shape, current_shape))
+            continue
+        restored.append(key)
+    return restored
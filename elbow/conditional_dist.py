@@ -2,11 +2,70 @@ import numpy as np
 import tensorflow as tf
 
 import uuid
+import warnings
 
 
 from elbow.util.misc import concrete_shape, broadcast_shape
+from elbow.checkpoint import input_variables
 
 
+# session shared by all node-level calls to sample() on one graph,
+# along with that graph and the set of variables it has already
+# initialized. Only the most recently sampled graph keeps a session,
+# and Model.close releases it (see close_sampling_session).
+_sampling_session = {"graph": None, "session": None, "initialized": None}
+
+def sampling_session(graph, variables):
+    """
+    Return a session on graph for drawing samples outside of a Model,
+    creating it on first use (and closing the previous one if it was
+    on another graph), with the given variables initialized. Variables
+    are only initialized the first time they're asked for, so repeated
+    calls don't reset any state or leak sessions. 
+    """
+    if _sampling_session["graph"] is not graph:
+        close_sampling_session()
+        _sampling_session.update(graph=graph, session=tf.Session(graph=graph), initialized=set())
+    sess = _sampling_session["session"]
+    initialized = _sampling_session["initialized"]
+
+    with graph.as_default():
+        new_vars = [v for v in variables if v not in initialized]
+        if len(new_vars) > 0:
+            sess.run(tf.variables_initializer(new_vars))
+            initialized.update(new_vars)
+    return sess
+
+def close_sampling_session(graph=None):
+    """
+    Close the shared sampling session if it's on graph (or whatever 
+    graph it's on, if None), so that it no longer keeps the graph alive.
+    """
+    if graph is None or _sampling_session["graph"] is graph:
+        if _sampling_session["session"] is not None:
+            _sampling_session["session"].close()
+        _sampling_session.update(graph=None, session=None, initialized=None)
+
+def _remember(obj, names, saved):
+    # record the current values of obj's attributes (None if unset)
+    # the first time they're replaced, so restore_draws can undo this
+    for name in names:
+        if (obj, name) not in saved:
+            saved[(obj, name)] = getattr(obj, name, None)
+
+def _replace(obj, attrs, saved):
+    _remember(obj, attrs.keys(), saved)
+    for (name, val) in attrs.items():
+        setattr(obj, name, val)
+
+def restore_draws(saved):
+    """
+    Undo a sequence of _redraw calls, given the dict they recorded
+    replaced values in. 
+    """
+    for ((obj, name), val) in saved.items():
+        setattr(obj, name, val)
+
 class ConditionalDistribution(object):
     """
     
@@ -15,9 +74,15 @@ class ConditionalDistribution(object):
 
     The inputs are assumed to be random variables described by their own respective distributions. 
     Thus the object graph implicitly represents a directed graphical model (Bayesian network).
+
+    A replicated node holds independent copies (replicas) of the same
+    variable along the leading axis of its shape, and its log density 
+    and entropy terms are vectors of per-replica sums (see _reduce_sum),
+    so that a Model of replicated nodes can train many copies of a 
+    model as one graph (see elbow.replicated). 
     """
 
-    def __init__(self, shape=None, name=None, local=False, **kwargs):
+    def __init__(self, shape=None, name=None, local=False, replicated=False, **kwargs):
 
         if name is None:
             name = str(uuid.uuid4().hex)[:6]
@@ -25,6 +90,7 @@ class ConditionalDistribution(object):
         self.name = name
 
         self.local = local
+        self.replicated = replicated
         self._q_distribution = None
         self.shape = shape
         
@@ -121,14 +187,78 @@ class ConditionalDistribution(object):
         
         return sample, entropy
     
-    def sample(self, seed=0):
-        init = tf.global_variables_initializer()
-        tf.set_random_seed(seed)
+    def _redraw(self, saved):
+        """
+        Replace this node's sample, its entropy and any parameters 
+        derived from its inputs with a fresh draw, computed from the 
+        current _sampled values of its random inputs. The replaced 
+        values are recorded in saved, so that restore_draws can put
+        them back. Redrawing a set of nodes in topological order 
+        (e.g. inside a tf.while_loop body) gives an independent draw
+        of every term built from them, without rebuilding the model. 
+        """
+        input_samples = {}
+        for param, node in self.inputs_random.items():
+            input_samples[param] = node._sampled
+        input_samples.update(self.inputs_nonrandom)
+
+        # _sample_and_entropy may itself set _sampled
+        _remember(self, ["_sampled", "_sampled_entropy"], saved)
+        sample, entropy = self._sample_and_entropy(**input_samples)
 
-        sess = tf.Session()
-        sess.run(init)
+        attrs = dict(input_samples)
+        attrs.update(self.derived_parameters(**input_samples))
+        attrs["_sampled"] = sample
+        attrs["_sampled_entropy"] = entropy
+        _replace(self, attrs, saved)
+
+    def _rebind_parameters(self, rebuild, saved):
+        """
+        Replace each of this node's nonrandom inputs by rebuild(input),
+        e.g. the same parameter recomputed from a fresh read of its 
+        variables, along with the parameters derived from them. As with
+        _redraw, the replaced values are recorded in saved; the node's
+        sample isn't redrawn. 
+        """
+        inputs_nonrandom = {name: rebuild(inp) for (name, inp) in self.inputs_nonrandom.items()}
+        input_samples = {}
+        for param, node in self.inputs_random.items():
+            input_samples[param] = node._sampled
+        input_samples.update(inputs_nonrandom)
+
+        attrs = dict(input_samples)
+        attrs.update(self.derived_parameters(**input_samples))
+        attrs["inputs_nonrandom"] = inputs_nonrandom
+        _replace(self, attrs, saved)
+        
+    def sample(self, seed=None):
+        # seed is accepted for compatibility, but never had any effect:
+        # the random ops were already created (and seeded) with the node
+        if seed is not None:
+            warnings.warn("the seed argument of sample() is deprecated and ignored; "
+                          "call tf.set_random_seed before building the model instead", DeprecationWarning)
+        sess = sampling_session(self.graph(), input_variables(self._sampled))
         return sess.run(self._sampled)
         
+    def supports_replication(self):
+        """
+        Whether this class computes its log density and entropy with
+        _reduce_sum, so that replicated=True gives per-replica terms.
+        """
+        return False
+        
+    def _reduce_sum(self, x):
+        """
+        Sum the elementwise terms x of a log density or entropy. For a
+        replicated node, sum over all but the leading (replica) axis 
+        instead, giving a vector with one term per replica. 
+        """
+        if not self.replicated:
+            return tf.reduce_sum(x)
+        if tuple(x.get_shape().as_list()) != tuple(self.shape):
+            x = x + tf.zeros(self.shape, dtype=x.dtype)
+        return tf.reduce_sum(tf.reshape(x, (self.shape[0], -1)), axis=1)
+        
     def _parameterized_logp(self, *args, **kwargs):
         """
         Compute the log probability using the values of all fixed input
@@ -216,23 +346,36 @@ class ConditionalDistribution(object):
         #print "attaching", q_distribution, "at", self
         
         assert(self.shape == q_distribution.shape)
+        if q_distribution.replicated != self.replicated and not isinstance(q_distribution, WrapperNode):
+            raise Exception("Q distribution %s must be replicated exactly when %s is" % (q_distribution, self))
+        if q_distribution.replicated and not q_distribution.supports_replication():
+            raise Exception("Q distribution %s is replicated, but %s does not support replication" % (q_distribution, q_distribution.__class__.__name__))
         q_distribution.local = self.local
         self._q_distribution = q_distribution
 
+    def graph(self):
+        # the graph this node was built in, so that nodes attached
+        # later (Q distributions, observations) end up alongside it.
+        graph = getattr(self._sampled, "graph", None)
+        return graph if graph is not None else tf.get_default_graph()
+        
     def attach_map_q(self, replace_existing=False):
-        q_dist = WrapperNode(name="q_" + self.name, shape=self.shape)
+        with self.graph().as_default():
+            q_dist = WrapperNode(name="q_" + self.name, shape=self.shape)
         self.attach_q(q_dist, replace_existing=replace_existing)
         return q_dist
         
     def observe(self, observed_val, replace_existing=False):
-        tf_value = tf.convert_to_tensor(observed_val)
-        q_dist = WrapperNode(tf_value, name="observed_" + self.name)
+        with self.graph().as_default():
+            tf_value = tf.convert_to_tensor(observed_val)
+            q_dist = WrapperNode(tf_value, name="observed_" + self.name)
         self.attach_q(q_dist, replace_existing=replace_existing)
         return q_dist
 
     def observe_placeholder(self, replace_existing=False):
-        tf_value = tf.placeholder(shape=self.shape, dtype=self.dtype)
-        q_dist = WrapperNode(tf_value, name="observed_" + self.name)
+        with self.graph().as_default():
+            tf_value = tf.placeholder(shape=self.shape, dtype=self.dtype)
+            q_dist = WrapperNode(tf_value, name="observed_" + self.name)
         self.attach_q(q_dist, replace_existing=replace_existing)
         return tf_value
 
@@ -254,8 +397,9 @@ class WrapperNode(ConditionalDistribution):
             shape = concrete_shape(tf_value.get_shape())
         super(WrapperNode, self).__init__(shape=shape, tf_value=tf_value, **kwargs)
 
-        self.mean = self.tf_value
-        self.variance = tf.zeros_like(self.mean, name="variance")
+    def derived_parameters(self, tf_value, **kwargs):
+        return {"mean": tf_value,
+                "variance": tf.zeros_like(tf_value, name="variance")}
         
     def inputs(self):
         from elbow.parameterization import unconstrained
@@ -105,7 +105,7 @@ class DirichletMatrix(ConditionalDistribution):
     
     def __init__(self, alpha, **kwargs):
         super(DirichletMatrix, self).__init__(alpha=alpha, **kwargs)
-        self.N, self.K = self.shape
+        self.K = self.shape[-1]
         
     def inputs(self):
         return {"alpha": positive_exp}
@@ -127,8 +127,6 @@ class DirichletMatrix(ConditionalDistribution):
         return alpha_shape
         
     def default_q(self, **kwargs):
-        n, k = self.shape
-
         # TODO: should we prefer Simplex or Simplex1 transformation?
         # preliminarily: Simplex1 seems to yield degenerate
         # posteriors, can't represent some natural distributions on
@@ -137,7 +135,7 @@ class DirichletMatrix(ConditionalDistribution):
         #q1 = Gaussian(shape=(n, k-1))
         #return TransformedDistribution(q1, Simplex1, name="q_"+self.name)
 
-        q1 = Gaussian(shape=(n, k))
+        q1 = Gaussian(shape=self.shape)
         return TransformedDistribution(q1, Simplex, name="q_"+self.name)
         
     def reparameterized(self):
@@ -244,13 +242,19 @@ class Laplace(ConditionalDistribution):
         return loc + scale * std_laplace
 
     def _logp(self, result, loc, scale):
-        return -tf.reduce_sum(tf.abs(result-loc)/scale - tf.log(2*scale))
+        return -self._reduce_sum(tf.abs(result-loc)/scale - tf.log(2*scale))
 
     def _entropy(self, loc, scale):
-        return 1 + tf.reduce_sum(tf.log(2*scale))
+        return 1 + self._reduce_sum(tf.log(2*scale))
 
     def default_q(self, **kwargs):
-        return Laplace(shape=self.shape, name="q_"+self.name)
+        return Laplace(shape=self.shape, name="q_"+self.name, replicated=self.replicated)
+
+    def reparameterized(self):
+        return True
+
+    def supports_replication(self):
+        return True
 
 
 class MVGaussian(ConditionalDistribution):
@@ -328,15 +332,18 @@ class Gaussian(ConditionalDistribution):
         return eps * std + mean
     
     def _logp(self, result, mean, std):
-        lp = tf.reduce_sum(util.dists.gaussian_log_density(result, mean=mean, stddev=std))
+        lp = self._reduce_sum(util.dists.gaussian_log_density(result, mean=mean, stddev=std))
         return lp
 
     def _entropy(self, std, **kwargs):
         variance = tf.ones(self.shape) * std**2
+        if self.replicated:
+            # gaussian_entropy sums over all elements, so split it by replica
+            return self._reduce_sum(.5 * (1 + np.log(2*np.pi) + tf.log(variance)))
         return tf.reduce_sum(util.dists.gaussian_entropy(variance=variance))
 
     def default_q(self, **kwargs):
-        return Gaussian(shape=self.shape, name="q_"+self.name)
+        return Gaussian(shape=self.shape, name="q_"+self.name, replicated=self.replicated)
 
     def _expected_logp(self, q_result, q_mean=None, q_std=None):
 
@@ -349,16 +356,19 @@ class Gaussian(ConditionalDistribution):
         
         if is_gaussian(q_result) and not is_gaussian(q_mean):
             cross = util.dists.gaussian_cross_entropy(q_result.mean, q_result.variance, mean_sample, tf.square(std_sample))
-            elp = -tf.reduce_sum(cross)
+            elp = -self._reduce_sum(cross)
         elif not is_gaussian(q_result) and is_gaussian(q_mean):
             cross = util.dists.gaussian_cross_entropy(q_mean.mean, q_mean.variance, result_sample, tf.square(std_sample))
-            elp = -tf.reduce_sum(cross)
+            elp = -self._reduce_sum(cross)
         elif is_gaussian(q_result) and is_gaussian(q_mean):
             cross = util.dists.gaussian_cross_entropy(q_mean.mean, q_mean.variance + q_result.variance, q_result.mean, tf.square(std_sample))
-            elp = -tf.reduce_sum(cross)
+            elp = -self._reduce_sum(cross)
         else:
             elp = self._logp(result=result_sample, mean=mean_sample, std=std_sample)
         return elp
             
     def reparameterized(self):
         return True
+
+    def supports_replication(self):
+        return True
@@ -5,18 +5,67 @@ import tensorflow as tf
 import uuid
 import copy
 import time
+import threading
+import functools
 
-from elbow.transforms import DeterministicTransform
-from elbow.conditional_dist import ConditionalDistribution, WrapperNode
+try:
+    import queue
+except ImportError: # python 2
+    import Queue as queue
+
+from elbow.transforms import DeterministicTransform, TransformedDistribution
+from elbow.conditional_dist import ConditionalDistribution, WrapperNode, restore_draws, close_sampling_session
+from elbow.lazy_adam import LazyAdamOptimizer
+from elbow.checkpoint import CheckpointWriter, restore_checkpoint, load_variational_values, variational_values, input_variables, VARIABLE_OP_TYPES
+from elbow.parameterization import parameter_builds
+
+def topological_order(nodes):
+    """
+    Return the given nodes together with all of their ancestors, ordered
+    so that every node comes after its random inputs. Each node is
+    visited once, so this is linear in the size of the graph even
+    when ancestors are shared by many descendants. 
+    """
+    order = []
+    visited = set()
+    for root in nodes:
+        if root in visited:
+            continue
+        visited.add(root)
+
+        # iterative depth-first search, so deep models don't hit
+        # the recursion limit
+        stack = [(root, iter(root.inputs_random.values()))]
+        while stack:
+            node, inputs = stack[-1]
+            for inp in inputs:
+                if inp not in visited:
+                    visited.add(inp)
+                    stack.append((inp, iter(inp.inputs_random.values())))
+                    break
+            else:
+                stack.pop()
+                order.append(node)
+    return order
+
+def in_model_graph(method):
+    """
+    Decorator for Model methods that may create TF ops or Variables, 
+    so that these are always added to the model's own graph rather 
+    than whichever graph happens to be the default when the method
+    is called. 
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.graph.as_default():
+            return method(self, *args, **kwargs)
+    return wrapper
 
 def ancestors(node):
-    return set([node,] + [ancestor_node for inp in node.inputs_random.values() for ancestor_node in ancestors(inp)])
+    return set(topological_order([node,]))
 
 def ancestor_closure(nodes):
-    all_ancestors = set()
-    for node in nodes:
-        all_ancestors = all_ancestors.union(ancestors(node))
-    return all_ancestors
+    return set(topological_order(nodes))
 
 class Model(object):
 
@@ -26,7 +75,15 @@ class Model(object):
         # named_arg1=default1, etc) but python 2 doesn't allow named
         # arguments after optional positional arguments, so we have
         # to fake it by parsing kwargs manually.
-        args = {'minibatch_ratio': 1.0}
+        # n_particles > 1 estimates the ELBO (and its gradient) as an average
+        # over that many independent reparameterized draws of the variational
+        # nodes; terms with analytic expectations are unaffected. 
+        # lazy_adam uses LazyAdamOptimizer, which only updates the rows 
+        # of gathered variables (e.g. factor matrices) touched by each step.
+        # trainable_variables restricts the optimizer to the given list of
+        # variables (default: all trainable variables in the graph). 
+        args = {'minibatch_ratio': 1.0, 'graph': None, 'n_particles': 1, 'session_config': None,
+                'lazy_adam': False, 'trainable_variables': None}
         for arg, default_val in args.items():
             if arg in kwargs:
                 args[arg] = kwargs[arg]
@@ -35,10 +92,41 @@ class Model(object):
             raise TypeError('unexpected keyword arguments %s' % (kwargs.keys()))
         self.__dict__.update(args)
         
-        # the model includes all ancestors of the passed-in nodes. 
-        self.component_nodes = ancestor_closure(nodes)
+        # the model includes all ancestors of the passed-in nodes. we
+        # keep them in topological order for building the ELBO, and
+        # as a set for fast membership tests. 
+        self.component_order = topological_order(nodes)
+        self.component_nodes = set(self.component_order)
         self.by_name = {n.name : n for n in self.component_nodes}
 
+        # the model's ops, variables and session all live in the graph
+        # containing its nodes. The session only initializes the model's
+        # own variables, but a graph's memory is only freed with the graph,
+        # so to release a discarded model's memory, build the nodes of each
+        # model inside a fresh graph, e.g. `with tf.Graph().as_default(): ...`.
+        if self.graph is None:
+            self.graph = self._find_graph()
+
+        # set before validating the nodes, since close() (called by
+        # __del__ even if the constructor raises) needs them
+        self.session = None
+        self.feeder = None
+
+        # a model of replicated nodes (see ConditionalDistribution) holds
+        # n_replicas independent copies of itself along their leading axis
+        self.n_replicas = None
+        replicated = [n for n in self.component_order if n.replicated]
+        if len(replicated) > 0:
+            replica_counts = set([n.shape[0] for n in replicated])
+            if len(replicated) < len(self.component_order) or len(replica_counts) > 1:
+                raise Exception("either all or none of a model's nodes must be replicated, with the same number of replicas")
+            # other classes sum their terms over all elements, which
+            # would mix the replicas together
+            for n in replicated:
+                if not n.supports_replication():
+                    raise Exception("node %s is replicated, but %s does not support replication" % (n, n.__class__.__name__))
+            self.n_replicas = replica_counts.pop()
+
         # don't compute the variational nodes until actually needed by the ELBO constructor.
         # this allows us to attach variational nodes *after* creating the joint model, which
         # is useful if we want to observe sample from the joint model. 
@@ -47,13 +135,36 @@ class Model(object):
         # allow the user to add arbitrary custom terms to the variational bound
         self.bonus_terms = []
         
-        self.session = None
-        self.feeder = None
         self.elbo = None
+        self._posterior_cache = None
+
+        # the optimizer is built on the first call to train() and
+        # reused afterwards, so training can resume where it left off.
+        self._initialized_vars = set()
+        # variables created by the model itself, e.g. the optimizer's
+        self._model_variables = set()
+        self._train_step = None
+        self._adam_rate = None
+        self._averaged_train_steps = {}
+        self._elbo_averages = {}
+        self._train_loops = {}
+        self._elbo_samples = None
+        self._replica_elbos = None
+        self._joint_sample_ops = None
+        self._debug_ops = None
+        self._loop_ops = set()
         
     def __getitem__(self, a):
         return self.by_name[a]
 
+    def _find_graph(self):
+        for node in self.component_order:
+            graph = getattr(node._sampled, "graph", None)
+            if graph is not None:
+                return graph
+        return tf.get_default_graph()
+
+    @in_model_graph
     def construct_elbo(self, return_all=False):
         if self.elbo is None:
         
@@ -65,33 +176,116 @@ class Model(object):
             # which is not yet implemented. 
 
             vnodes = self.get_variational_nodes()
-            
-            global_elps = [n.expected_logp() for n in self.component_nodes if not n.local]
-            local_elps = [n.expected_logp() for n in self.component_nodes if n.local]
-
-            global_entropies = [n.entropy() for n in vnodes if not n.local]
-            local_entropies = [n.entropy() for n in vnodes if n.local]
 
-            symmetry_correction = tf.reduce_sum(tf.stack([n._hack_symmetry_correction() for n in self.component_nodes]))
-            other_corrections = tf.reduce_sum(tf.stack(self.bonus_terms))
-
-            
-            self.elp = tf.reduce_sum(tf.stack(global_elps)) + self.minibatch_ratio * tf.reduce_sum(tf.stack(local_elps))
-            self.entropy = tf.reduce_sum(tf.stack(global_entropies)) + self.minibatch_ratio * tf.reduce_sum(tf.stack(local_entropies))
+            if self.n_particles > 1:
+                # average the ELBO terms over several independent 
+                # reparameterized draws of the variational nodes. 
+                self._check_reparameterized(vnodes)
+                with tf.name_scope("particles"):
+                    elps, entropies = self._elbo_term_draws(self.n_particles)
+                self.elp = tf.reduce_mean(elps)
+                self.entropy = tf.reduce_mean(entropies)
+            else:
+                self.elp, self.entropy = self._elbo_terms(vnodes)
 
             self.elbo = self.elp + \
                         self.entropy + \
-                        symmetry_correction + \
-                        other_corrections
+                        self._elbo_corrections()
 
         if return_all:
             return self.elbo, self.elp, self.entropy
         else:
             return self.elbo        
         
+    @in_model_graph
+    def replica_elbos(self):
+        """
+        For a model of replicated nodes, a vector holding each replica's
+        own ELBO, i.e., the bound a Model of that replica alone would
+        compute. construct_elbo() is their sum, plus any bonus terms 
+        and symmetry corrections (which aren't split by replica). 
+        """
+        if self.n_replicas is None:
+            raise Exception("replica_elbos requires a model of replicated nodes")
+        if self._replica_elbos is None:
+            vnodes = self.get_variational_nodes()
+            with tf.name_scope("replica_elbos"):
+                if self.n_particles > 1:
+                    self._check_reparameterized(vnodes)
+                    elps, entropies = self._elbo_term_draws(self.n_particles, per_replica=True)
+                    self._replica_elbos = tf.reduce_mean(elps + entropies, axis=0)
+                else:
+                    elp, entropy = self._elbo_terms(vnodes, per_replica=True)
+                    self._replica_elbos = elp + entropy
+        return self._replica_elbos
+        
+    def _elbo_terms(self, vnodes, per_replica=False):
+        # the expected log density and entropy terms of the ELBO, at
+        # the current draw of each variational node
+        global_elps = [n.expected_logp() for n in self.component_order if not n.local]
+        local_elps = [n.expected_logp() for n in self.component_order if n.local]
+
+        global_entropies = [n.entropy() for n in vnodes if not n.local]
+        local_entropies = [n.entropy() for n in vnodes if n.local]
+
+        elp = self._sum_terms(global_elps, per_replica) + self.minibatch_ratio * self._sum_terms(local_elps, per_replica)
+        entropy = self._sum_terms(global_entropies, per_replica) + self.minibatch_ratio * self._sum_terms(local_entropies, per_replica)
+        return elp, entropy
+
+    def _sum_terms(self, terms, per_replica=False):
+        if self.n_replicas is None:
+            return tf.reduce_sum(tf.stack(terms))
+
+        # replicated nodes' terms are vectors over replicas; the only
+        # scalar terms are from unreplicated (observed or MAP) Q nodes
+        total = tf.zeros((self.n_replicas,), dtype=tf.float32)
+        for term in terms:
+            total += term
+        return total if per_replica else tf.reduce_sum(total)
+    
+    def _elbo_term_draws(self, n, per_replica=False):
+        """
+        Tensors of shape (n,) holding the elp and entropy terms of the
+        ELBO at n independent draws of the variational nodes (shape
+        (n, n_replicas) with per_replica, see _sum_terms). The terms
+        are built once, inside a loop whose body redraws every variational
+        node (see ConditionalDistribution._redraw), so the graph doesn't
+        grow with n (which may be a Tensor). Terms the nodes compute 
+        analytically are the same in every draw; only the sampled ones vary. 
+        """
+        vnodes = self.get_variational_nodes()
+
+        def draw(i):
+            saved = {}
+            for q in vnodes:
+                q._redraw(saved)
+            terms = self._elbo_terms(vnodes, per_replica=per_replica)
+            restore_draws(saved)
+            return terms
+
+        return self._record_loop_ops(tf.map_fn, draw, tf.range(n), dtype=(tf.float32, tf.float32))
+
+    def _record_loop_ops(self, build, *args, **kwargs):
+        """
+        Call build (e.g. tf.map_fn) and return its result, recording the
+        ops it adds to the graph as belonging to a while loop, since
+        those can't be given numerics checks (see _get_debug_ops). 
+        """
+        existing = set(self.graph.get_operations())
+        result = build(*args, **kwargs)
+        self._loop_ops.update(op for op in self.graph.get_operations() if op not in existing)
+        return result
+    
+    @in_model_graph
+    def _check_reparameterized(self, vnodes):
+        for q in vnodes:
+            base = q.dist if isinstance(q, TransformedDistribution) else q
+            if hasattr(base, "reparameterized") and not base.reparameterized():
+                raise Exception("multi-particle ELBO requires reparameterized Q distributions, but %s is not" % q)
+        
     def build_variational_model(self):
         # start with nodes that already have attached Q distributions
-        attached = [n for n in self.component_nodes if n._q_distribution is not None]
+        attached = [n for n in self.component_order if n._q_distribution is not None]
 
         i = 0
         while i < len(attached):
@@ -110,12 +304,13 @@ class Model(object):
                         print("WARNING: cannot attach inference network from %s to input %s (%s): %s" % (n, inp_name, inp_node, e))
             i += 1
 
-        for node in self.component_nodes:
+        for node in self.component_order:
             if node.local and (node._q_distribution is None):
                 raise Exception("node %s marked as local but no inference network is attached!" % (node))
             
-        explicit_qnodes = [node.q_distribution() for node in self.component_nodes]
-        return [node for node in ancestor_closure(explicit_qnodes) if node not in self.component_nodes]
+        # the variational nodes are returned in topological order
+        explicit_qnodes = [node.q_distribution() for node in self.component_order]
+        return [node for node in topological_order(explicit_qnodes) if node not in self.component_nodes]
 
     def get_variational_nodes(self):
         if self.variational_nodes is None:
@@ -123,6 +318,7 @@ class Model(object):
         return self.variational_nodes
 
 
+    @in_model_graph
     def full_map_inference(self):
         # attach MAP (delta fn) Q distributions to every node in the model
         for n in self.component_nodes:
@@ -136,23 +332,59 @@ class Model(object):
     def add_elbo_term(self, term):
         self.bonus_terms.append(term)
                 
+    @in_model_graph
     def elbo_terms(self):
         elps = {n.name: n.expected_logp() for n in self.component_nodes}
         entropies = {n.name: n.entropy() for n in self.get_variational_nodes()}
         return elps, entropies
 
+    @in_model_graph
     def get_session(self, seed=0, do_init=True):
 
         if self.session is None:
             tf.set_random_seed(seed)
-            self.session = tf.Session()
+            self.session = tf.Session(graph=self.graph, config=self.session_config)
 
             if do_init:
-                init = tf.global_variables_initializer()
-                self.session.run(init)
+                self.initialize_new_variables()
             
         return self.session
+
+    @in_model_graph
+    def initialize_new_variables(self):
+        """
+        Initialize any of the model's variables that it hasn't 
+        initialized yet (e.g., Q distributions or optimizer slots created
+        since the last call), leaving the current values of all others 
+        intact. Variables of other models sharing the graph aren't 
+        touched (see model_variables). 
+        """
+        new_vars = [v for v in self.model_variables() if v not in self._initialized_vars]
+        if len(new_vars) > 0:
+            self.session.run(tf.variables_initializer(new_vars))
+            self._initialized_vars.update(new_vars)
     
+    def model_variables(self):
+        """
+        The variables this model is computed from: those underlying 
+        its nodes (and variational nodes, once built), its bonus terms
+        and its ELBO, along with those it created itself (e.g. the 
+        optimizer's moment estimates). 
+        """
+        nodes = list(self.component_order) + list(self.variational_nodes or [])
+        tensors = [t for node in nodes for t in list(node.inputs_nonrandom.values()) + [node._sampled] if t is not None]
+        tensors += list(self.bonus_terms)
+        if self.elbo is not None:
+            tensors.append(self.elbo)
+        variables = input_variables(tensors)
+        found = set(variables)
+        for v in list(self.trainable_variables or []) + sorted(self._model_variables, key=lambda v: v.name):
+            if v not in found:
+                variables.append(v)
+                found.add(v)
+        return variables
+        
+    @in_model_graph
     def evaluate_elbo_terms(self):
 
         sess = self.get_session()
@@ -172,35 +404,141 @@ class Model(object):
 
         return elp_vals, entropy_vals
         
+    @in_model_graph
     def posterior(self):
+        """
+        Return a dict mapping each variational node name to the current
+        values of its nonrandom inputs (the variational parameters).
+
+        All values are fetched in a single session.run, with a feed only
+        if some value depends on a placeholder. Inputs that can't be 
+        computed from the current feed (e.g. bare placeholders) are 
+        skipped. The result is cached until the next call to train().
+        """
+        if self._posterior_cache is not None:
+            return self._posterior_cache
+        
         session = self.get_session()
+        inputs = [(node.name, name, inp) for node in self.get_variational_nodes()
+                  for (name, inp) in node.inputs_nonrandom.items()]
+
+        # only ask for a feed if some value needs one, since each call
+        # advances a batch generator or uses up a prefetched batch
+        placeholder_deps = {}
+        fd = None
+        if any(_depends_on_placeholder(inp.op, set(), placeholder_deps) for (_, _, inp) in inputs):
+            fd = self.feed_dict()
+            fed_ops = set([t.op for t in fd.keys()]) if fd is not None else set()
+            placeholder_deps = {}
+            inputs = [(node_name, name, inp) for (node_name, name, inp) in inputs
+                      if not _depends_on_placeholder(inp.op, fed_ops, placeholder_deps)]
+        keys = [(node_name, name) for (node_name, name, inp) in inputs]
+        fetches = [inp for (node_name, name, inp) in inputs]
+
         posterior_vals = {}
-        for node in self.variational_nodes:
-            d = {}
-            for name, inp in node.inputs_nonrandom.items():
-                try:
-                    d[name] = session.run(inp, feed_dict=self.feed_dict())
-                except Exception as e: # from fetching a placeholder
-                    print(e)
-                    continue
-            
-            if len(d) > 0:
-                posterior_vals[node.name] = d
-                
+        for (node_name, name), val in zip(keys, session.run(fetches, feed_dict=fd)):
+            if node_name not in posterior_vals:
+                posterior_vals[node_name] = {}
+            posterior_vals[node_name][name] = val
+
+        self._posterior_cache = posterior_vals
         return posterior_vals
 
-    def sample(self, seed=0):
+    @in_model_graph
+    def sample(self, seed=0, n=None, chunk_size=None):
+        """
+        Draw from the joint (prior) distribution of the model, returning
+        a dict mapping node names to sampled values. 
+
+        If n is given, we return n independent joint draws stacked along
+        a new leading axis. These are taken by an in-graph loop (built 
+        once, whatever n), in one session.run per chunk of chunk_size 
+        draws (default: all n at once). 
+        """
         sess = self.get_session(seed=seed)
-        samples = {}
 
-        sampled = sess.run([node._sampled for node in self.component_nodes], feed_dict=self.feed_dict())
-        
-        for node, sval in zip(self.component_nodes, sampled):
-            samples[node.name] = sval
+        if n is None:
+            fetches = [node._sampled for node in self.component_order]
+            sampled = sess.run(fetches, feed_dict=self.feed_dict())
+            return {node.name: sval for (node, sval) in zip(self.component_order, sampled)}
+
+        n_draws, joint_samples = self._joint_samples()
+        self.initialize_new_variables()
+        if chunk_size is None:
+            chunk_size = n
+        chunks = []
+        n_done = 0
+        while n_done < n:
+            fd = self.feed_dict()
+            fd = dict(fd) if fd is not None else {}
+            fd[n_draws] = min(chunk_size, n - n_done)
+            chunks.append(sess.run(joint_samples, feed_dict=fd))
+            n_done += fd[n_draws]
+
+        samples = {}
+        for i, node in enumerate(self.component_order):
+            samples[node.name] = np.concatenate([chunk[i] for chunk in chunks])
         return samples
+
+    def _joint_samples(self):
+        """
+        Build (on first use) Tensors holding independent joint draws of
+        every model node, stacked along a leading axis, along with the
+        scalar placeholder giving the number of draws. Each draw redraws
+        the nodes in topological order (see ConditionalDistribution._redraw). 
+        """
+        if self._joint_sample_ops is None:
+            n_draws = tf.placeholder(dtype=tf.int32, shape=(), name="n_joint_samples")
+
+            def draw(i):
+                saved = {}
+                for node in self.component_order:
+                    node._redraw(saved)
+                sampled = [node._sampled for node in self.component_order]
+                restore_draws(saved)
+                return sampled
+
+            dtypes = [node._sampled.dtype for node in self.component_order]
+            with tf.name_scope("joint_samples"):
+                samples = self._record_loop_ops(tf.map_fn, draw, tf.range(n_draws), dtype=dtypes)
+            self._joint_sample_ops = (n_draws, samples)
+        return self._joint_sample_ops
         
+    @in_model_graph
     def train(self, adam_rate=0.1, stopping_rule=None, steps=None,
-              avg_decay=None, debug=False, print_s=1):
+              avg_decay=None, debug=False, print_s=1, fused=True,
+              steps_per_check=1, checkpoint_path=None, checkpoint_steps=None,
+              checkpoint_s=None):
+        """
+        Optimize the ELBO with Adam until the stopping rule fires. 
+        Repeated calls resume from the current parameters and Adam
+        state; a different adam_rate takes effect without rebuilding
+        the optimizer. 
+
+        If fused is True (the default), the ELBO, elp and entropy are
+        fetched from the same session.run as the optimizer step, so
+        the values reported are those of the forward pass used to
+        compute the gradient (i.e., at the parameters *before* the
+        update). Otherwise they are recomputed in a second run, which
+        redraws all samples and roughly doubles the cost of each step.
+
+        If steps_per_check > 1, the optimizer takes blocks of that many
+        steps between visits to the stopping rule. A moving average
+        of the ELBO is maintained in-graph alongside the Adam update,
+        so the intermediate steps fetch nothing back into Python, and
+        the stopping rule sees only the average at the end of each
+        block (via observe_average). Where possible, each block runs 
+        as an in-graph loop in a single session.run (see 
+        _get_train_loop); models with a registered feed, lazy_adam or
+        debug checks instead run each step of the block separately. 
+
+        If checkpoint_path is given, the variational parameters are
+        written there (see save_checkpoint) every checkpoint_steps steps 
+        and/or checkpoint_s seconds, without blocking the optimizer, 
+        and once more when training finishes. 
+
+        Returns the (elbo, elp, entropy) values from the final step.
+        """
         elbo, elp, entropy = self.construct_elbo(return_all=True)
 
 
@@ -212,39 +550,331 @@ class Model(object):
             else:
                 stopping_rule = MovingAverageStopper()
         try:
-            train_step = tf.train.AdamOptimizer(adam_rate).minimize(-elbo)
+            train_step = self._get_train_step(elbo, adam_rate)
         except ValueError as e:
             print(e)
             return
             
         if debug:
-            debug_ops = tf.add_check_numerics_ops()
+            debug_ops, elbo = self._get_debug_ops(elbo)
 
+        if steps_per_check > 1:
+            decay = getattr(stopping_rule, "decay", 0.99)
+            block_step, elbo_avg, reset_avg = self._get_averaged_train_step(train_step, elbo, decay)
+            train_loop = None
+            if self.feeder is None and not self.lazy_adam and not debug:
+                train_loop = self._get_train_loop(decay)
+            
         session = self.get_session(do_init=False)
-
-        init = tf.global_variables_initializer()
-        session.run(init)
+        self.initialize_new_variables()
+        self._set_adam_rate(adam_rate)
+        self._posterior_cache = None
         
-        elbo_val = None
-        running_elbo = 0
+        elbo_val, elp_val, entropy_val = None, None, None
         i = 0
         t = -np.inf
         stopping_rule.reset()
+
+        checkpoints = None
+        if checkpoint_path is not None:
+            checkpoints = CheckpointWriter(self, checkpoint_path,
+                                           every_steps=checkpoint_steps,
+                                           every_s=checkpoint_s)
+            
+        if steps_per_check > 1:
+            session.run(reset_avg)
+            n_block = stopping_rule.block_size(steps_per_check)
+            while n_block > 0:
+                if debug:
+                    session.run(debug_ops)
+
+                if train_loop is not None:
+                    n_loop_steps, loop_outputs = train_loop
+                    elbo_avg_val, elbo_val, elp_val, entropy_val = session.run(loop_outputs, feed_dict={n_loop_steps: n_block})
+                else:
+                    for j in range(n_block-1):
+                        session.run(block_step, feed_dict=self.feed_dict())
+                    _, elbo_avg_val, elbo_val, elp_val, entropy_val = session.run((block_step, elbo_avg, elbo, elp, entropy), feed_dict=self.feed_dict())
+                i += n_block
+                if checkpoints is not None:
+                    checkpoints.step(n_block)
+                
+                if print_s is not None and (time.time() - t) > print_s:
+                    print("step %d elp %.2f entropy %.2f elbo %.2f avg %.2f" % (i, elp_val, entropy_val, elbo_val, elbo_avg_val))
+                    t = time.time()
+
+                if stopping_rule.observe_average(elbo_avg_val, n_steps=n_block):
+                    break
+                n_block = stopping_rule.block_size(steps_per_check)
+
+            self._finish_training(print_s, checkpoints)
+            return elbo_val, elp_val, entropy_val
+        
         while not stopping_rule.observe(elbo_val):
             if debug:
                 session.run(debug_ops)
 
             fd = self.feed_dict()
-                
-            session.run(train_step, feed_dict=fd)
 
-            elbo_val, elp_val, entropy_val = session.run((elbo, elp, entropy), feed_dict=fd)
+            if fused:
+                _, elbo_val, elp_val, entropy_val = session.run((train_step, elbo, elp, entropy), feed_dict=fd)
+            else:
+                session.run(train_step, feed_dict=fd)
+                elbo_val, elp_val, entropy_val = session.run((elbo, elp, entropy), feed_dict=fd)
+                
             if print_s is not None and (time.time() - t) > print_s:
                 print("step %d elp %.2f entropy %.2f elbo %.2f" % (i, elp_val, entropy_val, elbo_val))
                 t = time.time()
                 
             i += 1
-            
+            if checkpoints is not None:
+                checkpoints.step()
+
+        self._finish_training(print_s, checkpoints)
+        return elbo_val, elp_val, entropy_val
+
+    def _get_debug_ops(self, elbo):
+        """
+        Build (on first use) an op checking every float value in the 
+        graph for NaN and Inf, along with a checked copy of elbo to
+        fetch at each step. tf.add_check_numerics_ops does the former
+        but rejects graphs containing while loops (e.g. the map_fn of
+        the multi-particle ELBO), so we skip the ops recorded by 
+        _record_loop_ops and rely on the check of the final ELBO. We also skip
+        values that need a feed, since the debug op is run without one.
+        """
+        if self._debug_ops is None:
+            checks = []
+            placeholder_deps = {}
+            for op in self.graph.get_operations():
+                if op in self._loop_ops or _depends_on_placeholder(op, set(), placeholder_deps):
+                    continue
+                for output in op.outputs:
+                    if output.dtype in (tf.float16, tf.float32, tf.float64):
+                        checks.append(tf.check_numerics(output, message="%s:%d" % (op.name, output.value_index)))
+            checked_elbo = tf.check_numerics(elbo, message="elbo")
+            self._debug_ops = (tf.group(*checks), checked_elbo)
+        return self._debug_ops
+        
+    def _finish_training(self, print_s, checkpoints):
+        if checkpoints is not None:
+            checkpoints.save(block=True)
+        if print_s is not None and isinstance(self.feeder, PrefetchingFeeder):
+            print(self.feeder.report())
+
+    def _get_train_step(self, elbo, adam_rate):
+        """
+        Build the Adam update on first use, with the learning rate held 
+        in a variable so later calls to train() can change it without
+        rebuilding the optimizer or discarding its moment estimates. 
+        """
+        if self._train_step is None:
+            with tf.name_scope("adam_rate"):
+                rate = tf.Variable(np.float32(adam_rate), trainable=False, name="rate")
+                new_rate = tf.placeholder(dtype=tf.float32, shape=(), name="new_rate")
+                set_rate = tf.assign(rate, new_rate)
+            optimizer = LazyAdamOptimizer(rate) if self.lazy_adam else tf.train.AdamOptimizer(rate)
+            if len(self._loop_ops) > 0:
+                # the gradient of a while loop is another while loop
+                train_step = self._record_loop_ops(optimizer.minimize, -elbo, var_list=self.trainable_variables)
+            else:
+                train_step = optimizer.minimize(-elbo, var_list=self.trainable_variables)
+
+            self._train_step = train_step
+            self._optimizer = optimizer
+            self._model_variables.update([rate,] + optimizer.variables())
+            self._adam_rate_ops = (rate, new_rate, set_rate)
+            self._adam_rate = adam_rate
+        return self._train_step
+
+    def _set_adam_rate(self, adam_rate):
+        if adam_rate != self._adam_rate:
+            rate, new_rate, set_rate = self._adam_rate_ops
+            self.session.run(set_rate, feed_dict={new_rate: adam_rate})
+            self._adam_rate = adam_rate
+        
+    def _get_averaged_train_step(self, train_step, elbo, decay):
+        """
+        Wrap the optimizer step so that each run also folds the ELBO
+        from its forward pass into an exponential moving average held
+        in a TF variable. Returns the combined op, the tensor holding 
+        the updated average, and an op that restarts the average. 
+        """
+        if decay not in self._averaged_train_steps:
+            n_observed, avg = self._get_elbo_average(decay)
+            with tf.name_scope("elbo_moving_average"):
+                updated = tf.where(n_observed > 0, decay * avg + (1-decay) * elbo, elbo)
+                avg_update = tf.assign(avg, updated)
+                # count this step only after the average has read the old count
+                with tf.control_dependencies([avg_update]):
+                    count_update = tf.assign_add(n_observed, 1)
+
+                with tf.control_dependencies([train_step, count_update]):
+                    elbo_avg = tf.identity(avg_update)
+                block_step = tf.group(train_step, avg_update, count_update)
+                reset = tf.assign(n_observed, 0)
+            self._averaged_train_steps[decay] = (block_step, elbo_avg, reset)
+        return self._averaged_train_steps[decay]
+
+    def _get_elbo_average(self, decay):
+        # the variables holding the ELBO moving average at a given decay
+        # rate, shared by the averaged train step and the train loop
+        if decay not in self._elbo_averages:
+            with tf.name_scope("elbo_moving_average"):
+                n_observed = tf.Variable(0, dtype=tf.int32, trainable=False, name="n_observed")
+                avg = tf.Variable(0.0, dtype=tf.float32, trainable=False, name="avg")
+            self._model_variables.update([n_observed, avg])
+            self._elbo_averages[decay] = (n_observed, avg)
+        return self._elbo_averages[decay]
+
+    def _get_train_loop(self, decay):
+        """
+        Build (on first use) a tf.while_loop taking a given number of
+        Adam steps, so a block of steps runs in one session.run. Returns
+        the scalar placeholder giving the number of steps, along with 
+        Tensors holding the ELBO moving average (updated as by the 
+        averaged train step), and the elbo, elp and entropy of the 
+        final step. 
+
+        Values computed outside the loop are read once per run, so the
+        body rebuilds the ELBO from fresh reads of the variables at 
+        each step: every node's parameters are recomputed (see 
+        ConditionalDistribution._rebind_parameters and 
+        parameterization.parameter_builds) and the variational nodes
+        redrawn. The update is Adam's, on the same moment estimates
+        and bias corrections as the optimizer of _get_train_step, so 
+        looped and separate steps can be freely mixed. If any value in
+        the ELBO still comes from a variable read outside the loop 
+        (e.g. a parameter built directly from a tf.Variable, or a bonus
+        term), the loop would train on stale values, so we return None
+        and train() runs each step separately. 
+        """
+        if decay in self._train_loops:
+            return self._train_loops[decay]
+
+        optimizer = self._optimizer
+        rate = self._adam_rate_ops[0]
+        n_observed, avg = self._get_elbo_average(decay)
+        beta1_power, beta2_power = optimizer._get_beta_accumulators()
+        beta1, beta2, epsilon = optimizer._beta1, optimizer._beta2, optimizer._epsilon
+        var_list = self.trainable_variables if self.trainable_variables is not None else tf.trainable_variables()
+        slots = [(var, optimizer.get_slot(var, "m"), optimizer.get_slot(var, "v")) for var in var_list]
+        slots = [(var, m, v) for (var, m, v) in slots if m is not None]
+        
+        builds = parameter_builds(self.graph)
+        vnodes = self.get_variational_nodes()
+        nodes = list(self.component_order) + list(vnodes)
+        loop_elbos = []
+
+        def body(i, count, elbo_avg, elbo, elp, entropy):
+            # read each variable after the previous step's update
+            reads = {}
+            def read(var):
+                if var not in reads:
+                    with tf.control_dependencies([i]):
+                        reads[var] = var.read_value()
+                return reads[var]
+
+            def rebuild(value):
+                if isinstance(value, tf.Variable):
+                    return read(value)
+                if value in builds:
+                    build, variables = builds[value]
+                    return build(*[read(var) for var in variables])
+                return value
+
+            params = [read(var) for (var, m, v) in slots]
+            saved = {}
+            for node in nodes:
+                node._rebind_parameters(rebuild, saved)
+            if self.n_particles > 1:
+                elps, entropies = self._elbo_term_draws(self.n_particles)
+                step_elp, step_entropy = tf.reduce_mean(elps), tf.reduce_mean(entropies)
+            else:
+                for q in vnodes:
+                    q._redraw(saved)
+                step_elp, step_entropy = self._elbo_terms(vnodes)
+            step_elbo = step_elp + step_entropy + self._elbo_corrections()
+            restore_draws(saved)
+            loop_elbos.append(step_elbo)
+
+            grads = tf.gradients(-step_elbo, params)
+            b1_power, b2_power = read(beta1_power), read(beta2_power)
+            lr = read(rate) * tf.sqrt(1 - b2_power) / (1 - b1_power)
+            updates = []
+            for (var, m, v), grad in zip(slots, grads):
+                if grad is None:
+                    continue
+                grad = tf.convert_to_tensor(grad)
+                m_t = tf.assign(m, beta1 * read(m) + (1 - beta1) * grad)
+                v_t = tf.assign(v, beta2 * read(v) + (1 - beta2) * tf.square(grad))
+                updates.append(tf.assign_sub(var, lr * m_t / (tf.sqrt(v_t) + epsilon)))
+            with tf.control_dependencies(updates):
+                updates = [tf.assign(beta1_power, b1_power * beta1),
+                           tf.assign(beta2_power, b2_power * beta2)]
+
+            with tf.control_dependencies(updates):
+                new_avg = tf.where(count > 0, decay * elbo_avg + (1-decay) * step_elbo, step_elbo)
+                return (i + 1, count + 1, new_avg,
+                        tf.identity(step_elbo), tf.identity(step_elp), tf.identity(step_entropy))
+
+        with tf.name_scope("train_loop"):
+            n_steps = tf.placeholder(dtype=tf.int32, shape=(), name="n_steps")
+            existing = set(self.graph.get_operations())
+            initial = (tf.constant(0), n_observed.read_value(), avg.read_value(),
+                       tf.constant(0.0), tf.constant(0.0), tf.constant(0.0))
+            outputs = self._record_loop_ops(tf.while_loop, lambda i, *values: i < n_steps,
+                                            body, initial, parallel_iterations=1)
+            loop_ops = [op for op in self.graph.get_operations() if op not in existing]
+            i, count, elbo_avg, elbo, elp, entropy = outputs
+            with tf.control_dependencies([tf.assign(n_observed, count), tf.assign(avg, elbo_avg)]):
+                fetches = tuple(tf.identity(t) for t in (elbo_avg, elbo, elp, entropy))
+
+        if _reads_stale_values(loop_ops):
+            print("some of this model's parameters can't be recomputed in a training loop, so each step of a block runs separately")
+            self._train_loops[decay] = None
+        else:
+            self._train_loops[decay] = (n_steps, fetches)
+        return self._train_loops[decay]
+
+    @in_model_graph
+    def save_checkpoint(self, path, block=True):
+        """
+        Write the current values of all variables underlying the 
+        variational nodes' parameters to path (an .npz file), keyed by 
+        node and input name. 
+        """
+        self.get_variational_nodes()
+        self.get_session()
+        return CheckpointWriter(self, path).save(block=block)
+
+    @in_model_graph
+    def restore(self, path, verbose=True):
+        """
+        Warm-start the variational parameters from a checkpoint written
+        by save_checkpoint, or from a dict returned by 
+        variational_values, possibly of a different (e.g. rebuilt or 
+        enlarged) model. Parameters are matched by node name; where a 
+        node has grown, only the leading block is restored. Returns the
+        keys that were restored. 
+        """
+        self.get_variational_nodes()
+        self.get_session(do_init=False)
+        self.initialize_new_variables()
+        self._posterior_cache = None
+        if isinstance(path, dict):
+            return load_variational_values(self, path, verbose=verbose)
+        return restore_checkpoint(self, path, verbose=verbose)
+
+    @in_model_graph
+    def variational_values(self):
+        """
+        Current values of the variational parameters, keyed by node 
+        name, for warm-starting another model via restore. 
+        """
+        self.get_variational_nodes()
+        self.get_session()
+        return variational_values(self)
 
     def feed_dict(self):
         if self.feeder is not None:
@@ -252,20 +882,177 @@ class Model(object):
         else:
             return None
 
-    def register_feed(self, feeder):
+    def register_feed(self, feeder, prefetch=None, n_threads=1):
+        """
+        Register a callable returning the feed dict for each step. 
+
+        If prefetch is given, the callable is run on n_threads background
+        threads that keep up to prefetch feed dicts ready in advance, 
+        so batch assembly overlaps with the TF computation (see
+        PrefetchingFeeder). With n_threads > 1 the callable must be
+        thread-safe. 
+        """
+        if isinstance(self.feeder, PrefetchingFeeder):
+            self.feeder.close()
+            
+        if prefetch is not None:
+            feeder = PrefetchingFeeder(feeder, capacity=prefetch, n_threads=n_threads)
         self.feeder = feeder
         
-    def monte_carlo_elbo(self, n_samples):
+    @in_model_graph
+    def monte_carlo_elbo(self, n_samples, vectorized=False, chunk_size=None, return_all=False):
+        """
+        Estimate the ELBO by averaging over n_samples draws. 
+
+        By default this evaluates the training objective n_samples 
+        times, one session.run per draw. With vectorized=True the draws
+        are instead taken inside a single in-graph loop, which redraws
+        every variational node and evaluates the same terms as the 
+        training objective, so the samples come back from one run per 
+        chunk of chunk_size draws (default: all n_samples at once). The
+        loop is built once, so the graph doesn't grow with n_samples; 
+        chunking only bounds the memory used by each run. 
+
+        If return_all is True, returns (mean, standard error, per-sample
+        values), otherwise just the mean. 
+        """
         
         sess = self.get_session()
-        elbo = self.construct_elbo()
-        samples = [sess.run(elbo, feed_dict=self.feed_dict()) for i in range(n_samples)]
+        if vectorized:
+            n_draws, elbo_samples = self._vectorized_elbo_samples()
+            self.initialize_new_variables()
+            if chunk_size is None:
+                chunk_size = n_samples
+            samples = []
+            while len(samples) < n_samples:
+                fd = self.feed_dict()
+                fd = dict(fd) if fd is not None else {}
+                fd[n_draws] = min(chunk_size, n_samples - len(samples))
+                samples.extend(sess.run(elbo_samples, feed_dict=fd))
+            samples = np.asarray(samples)
+        else:
+            elbo = self.construct_elbo()
+            samples = np.asarray([sess.run(elbo, feed_dict=self.feed_dict()) for i in range(n_samples)])
+
+        if return_all:
+            stderr = np.std(samples) / np.sqrt(len(samples))
+            return np.mean(samples), stderr, samples
         return np.mean(samples)
 
-    def __del__(self):
+    def _vectorized_elbo_samples(self):
+        """
+        Build (on first use) a Tensor holding independent draws of the 
+        ELBO, along with the scalar placeholder giving their number. 
+        """
+        if self._elbo_samples is None:
+            n_draws = tf.placeholder(dtype=tf.int32, shape=(), name="n_elbo_samples")
+            with tf.name_scope("elbo_samples"):
+                elps, entropies = self._elbo_term_draws(n_draws)
+                self._elbo_samples = (n_draws, elps + entropies + self._elbo_corrections())
+        return self._elbo_samples
+        
+    def _elbo_corrections(self):
+        symmetry_correction = tf.reduce_sum(tf.stack([n._hack_symmetry_correction() for n in self.component_order]))
+        other_corrections = tf.reduce_sum(tf.stack(self.bonus_terms))
+        return tf.cast(symmetry_correction, tf.float32) + other_corrections
+
+    def reset_variables(self):
+        """
+        Discard the model's session, so that all variables (variational
+        parameters, optimizer state) restart from their initial values,
+        and random ops from their seeds, on the next run. The graph, 
+        including any ELBO and optimizer ops built so far, is kept, so 
+        the model can be retrained from scratch without rebuilding it. 
+        """
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+        self._initialized_vars = set()
+        self._posterior_cache = None
+        # the rate variable is back at its initial value
+        self._adam_rate = None
+        
+    def close(self):
+        """
+        Release the model's session, any node-level sampling session on
+        its graph, and any background feeder threads. 
+        """
+        if isinstance(self.feeder, PrefetchingFeeder):
+            self.feeder.close()
         if self.session is not None:
             self.session.close()
+            self.session = None
+        close_sampling_session(self.graph)
+        
+    def __del__(self):
+        self.close()
+
+def _depends_on_placeholder(op, fed_ops, memo):
+    """
+    Check whether computing op requires a placeholder that isn't in 
+    fed_ops, memoizing the result for every op visited. 
+    """
+    return _depends_on(op, lambda o: o.type == "Placeholder", fed_ops, memo)
 
+def _reads_stale_values(loop_ops):
+    """
+    Check whether any of the given ops of a while loop bring a value
+    computed from a variable into the loop. Such a value is computed
+    once per run, before the loop starts, so it doesn't follow updates
+    made inside the loop. (Variables themselves may enter the loop, 
+    since reading them inside the loop gives their current values.)
+    """
+    memo = {}
+    is_variable = lambda o: o.type in VARIABLE_OP_TYPES
+    loop_ops = set(loop_ops)
+    for op in loop_ops:
+        # non-constant Enters bring in the initial values of loop variables,
+        # and those of nested loops bring in values from the outer loop
+        if op.type != "Enter" or not op.get_attr("is_constant") or op.inputs[0].dtype == tf.resource:
+            continue
+        if op.inputs[0].op in loop_ops:
+            continue
+        if _depends_on(op.inputs[0].op, is_variable, set(), memo):
+            return True
+    return False
+
+def _depends_on(op, is_source, stop_ops, memo):
+    """
+    Check whether op is computed from some op for which is_source is
+    true, without passing through stop_ops, memoizing the result for 
+    every op visited. 
+    """
+    if op in memo:
+        return memo[op]
+
+    stack = [op]
+    visiting = set()
+    while stack:
+        current = stack[-1]
+        if current in memo:
+            stack.pop()
+            continue
+        visiting.add(current)
+        if current in stop_ops:
+            memo[current] = False
+            stack.pop()
+            continue
+        if is_source(current):
+            memo[current] = True
+            stack.pop()
+            continue
+        
+        parents = [t.op for t in current.inputs] + list(current.control_inputs)
+        # (parents already on the stack only occur in graph cycles,
+        # i.e. while loops, and can be ignored)
+        pending = [p for p in parents if p not in memo and p not in visiting]
+        if len(pending) > 0:
+            stack.extend(pending)
+        else:
+            memo[current] = any(memo.get(p, False) for p in parents)
+            stack.pop()
+    return memo[op]
+        
 class StepCountStopper(object):
 
     def __init__(self, step_count=1000):
@@ -278,10 +1065,24 @@ class StepCountStopper(object):
     def observe(self, v):
         self.steps += 1
         if v is not None and not np.isfinite(v):
-            raise Exception("stopping after %d steps due to non-finite objective %.2f" % (self.steps, v))
+            raise FloatingPointError("stopping after %d steps due to non-finite objective %.2f" % (self.steps, v))
             
 
         return self.steps > self.step_count
+
+    def block_size(self, n_steps):
+        # the size of the next block of optimizer steps, cut short so
+        # that the blocks add up to step_count
+        return min(n_steps, self.step_count - self.steps)
+    
+    def observe_average(self, v, n_steps=1):
+        # called after each block of n_steps optimizer steps, with the
+        # in-graph moving average of the objective over those steps.
+        self.steps += n_steps
+        if not np.isfinite(v):
+            raise FloatingPointError("stopping after %d steps due to non-finite objective %.2f" % (self.steps, v))
+
+        return self.steps >= self.step_count
         
 class MovingAverageStopper(object):
 
@@ -313,25 +1114,156 @@ class MovingAverageStopper(object):
 
         return (self.steps > self.min_steps and self.moving_average <= old_avg + self.eps)
 
+    def block_size(self, n_steps):
+        return n_steps
+    
+    def observe_average(self, v, n_steps=1):
+        # called after each block of n_steps optimizer steps, with a moving
+        # average (at our decay rate) computed in-graph. We stop when the
+        # average improved by less than eps per step across the block. 
+        self.steps += n_steps
+
+        if not np.isfinite(v):
+            return True
+
+        if self.moving_average is None:
+            self.moving_average = v
+            return False
+
+        old_avg = self.moving_average
+        self.moving_average = v
+
+        return (self.steps > self.min_steps and self.moving_average <= old_avg + self.eps * n_steps)
+
 
 class BatchGenerator(object):
     """
-    Return random sets of batch_size rows from an input numpy array. 
+    Return random sets of batch_size rows from an input numpy array,
+    or from the path of a .npy file, which is memory-mapped so that 
+    datasets larger than RAM only have each batch's rows read in. 
+
+    Each epoch visits every row once, in a random order. We shuffle 
+    only the row indices and gather each batch's rows on demand. If n
+    isn't a multiple of batch_size, the final batch of an epoch is 
+    either filled out with rows from the start of the next epoch (the
+    default, so every batch has the same shape) or, with 
+    partial_batches=True, returned short. 
     """
     
-    def __init__(self, data, batch_size):
+    def __init__(self, data, batch_size, partial_batches=False):
+        if isinstance(data, str):
+            data = np.load(data, mmap_mode="r")
         self.data = data
         self.n = data.shape[0]
         self.batch_size=batch_size
+        self.partial_batches = partial_batches
+        
+        self.idx = self.n
+        self.perm = None
 
-        self.idx = self.n+1
-
-    def next_batch(self):
-        if self.idx + self.batch_size > self.n:
+    def _next_idxs(self, k):
+        if self.idx >= self.n:
             self.idx = 0
-            self.shuffled = self.data[np.random.permutation(self.n)]
+            self.perm = np.random.permutation(self.n)
+        idxs = self.perm[self.idx:self.idx+k]
+        self.idx += len(idxs)
+        return idxs
+        
+    def next_batch(self):
+        idxs = self._next_idxs(self.batch_size)
+        while len(idxs) < self.batch_size and not self.partial_batches:
+            idxs = np.concatenate([idxs, self._next_idxs(self.batch_size - len(idxs))])
+
+        # reading rows in order is much faster from a memmap, and the
+        # order of rows within a batch doesn't matter. 
+        return self.data[np.sort(idxs)]
 
-        batch = self.shuffled[self.idx:self.idx+self.batch_size]
-        self.idx += self.batch_size
-        return batch
-                                                                                                                            
+
+class PrefetchingFeeder(object):
+    """
+    Wraps a feed dict callable (e.g. a lambda around BatchGenerator.next_batch)
+    so that the next `capacity` feed dicts are built on background threads
+    while the trainer runs. Calling the object returns the next ready feed 
+    dict. 
+
+    Array values are copied as they are produced, since some generators
+    (e.g. BatchDenseGeneratorByUser) reuse a single output buffer across
+    calls. We count how often the trainer asked for a batch before one
+    was ready (n_starved out of n_calls). 
+
+    If the wrapped callable raises, all workers stop, and every later
+    call raises the same error rather than waiting for a batch that 
+    will never come. 
+    """
+
+    def __init__(self, feeder, capacity=4, n_threads=1, copy_arrays=True):
+        self.feeder = feeder
+        self.copy_arrays = copy_arrays
+        self.queue = queue.Queue(maxsize=capacity)
+
+        self.n_calls = 0
+        self.n_starved = 0
+        self.wait_s = 0.0
+        
+        self._stopped = threading.Event()
+        self._error = None
+        self.threads = [threading.Thread(target=self._worker) for i in range(n_threads)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def _worker(self):
+        while not self._stopped.is_set():
+            try:
+                fd = self.feeder()
+                if fd is not None and self.copy_arrays:
+                    fd = {k: np.array(v) if isinstance(v, np.ndarray) else v for (k, v) in fd.items()}
+            except Exception as e:
+                self._error = e
+                self._stopped.set()
+                # wake up a caller blocked waiting for a batch (if the
+                # queue is full, there isn't one)
+                try:
+                    self.queue.put_nowait(None)
+                except queue.Full:
+                    pass
+                return
+
+            # block until there's room, but wake up periodically to
+            # notice if we've been closed.
+            while not self._stopped.is_set():
+                try:
+                    self.queue.put(fd, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+                
+    def __call__(self):
+        if self._error is not None:
+            raise self._error
+        
+        self.n_calls += 1
+        try:
+            fd = self.queue.get_nowait()
+        except queue.Empty:
+            self.n_starved += 1
+            t0 = time.time()
+            fd = self.queue.get()
+            self.wait_s += time.time() - t0
+
+        if self._error is not None:
+            raise self._error
+        return fd
+
+    def starved_fraction(self):
+        return self.n_starved / float(max(self.n_calls, 1))
+    
+    def report(self):
+        return "feeder starved on %d of %d steps (%.1f%%), waited %.2fs total" % (self.n_starved, self.n_calls, 100*self.starved_fraction(), self.wait_s)
+    
+    def close(self):
+        # workers notice within one put() timeout, or once the 
+        # callable returns
+        self._stopped.set()
+        for thread in self.threads:
+            thread.join()
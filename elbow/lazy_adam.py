@@ -0,0 +1,86 @@
+from __future__ import print_function
+import tensorflow as tf
+
+"""
+An Adam optimizer whose cost per step, for variables that are only
+read through tf.gather (e.g. the factor matrices of a sparse matrix
+factorization trained on minibatches), scales with the number of
+gathered rows rather than the size of the variable.
+"""
+
+class LazyAdamOptimizer(tf.train.AdamOptimizer):
+    """
+    Adam, except that a variable receiving a sparse gradient
+    (IndexedSlices, as produced by tf.gather) only has the rows in
+    the gradient updated. The stock optimizer decays the moment
+    estimates of every row on every step, which costs O(rows * K)
+    even when a minibatch touches only a few rows.
+
+    Instead we record the step at which each row was last updated (in
+    a per-row slot, created only for variables with sparse gradients),
+    and when a row is next touched we first apply the decay it missed,
+    beta^(steps skipped), to its moments. The moments of touched rows
+    are thus exactly those of dense Adam; the only difference is that
+    untouched rows don't keep drifting along their stale momentum.
+    Variables with dense gradients get the usual Adam update.
+    """
+
+    def apply_gradients(self, grads_and_vars, global_step=None, name=None):
+        grads_and_vars = list(grads_and_vars)
+        # only variables with sparse gradients need per-row step counts
+        self._sparse_vars = set(v for (g, v) in grads_and_vars if isinstance(g, tf.IndexedSlices))
+        return super(LazyAdamOptimizer, self).apply_gradients(grads_and_vars, global_step=global_step, name=name)
+    
+    def _create_slots(self, var_list):
+        super(LazyAdamOptimizer, self)._create_slots(var_list)
+        first_var = min(var_list, key=lambda x: x.name)
+        self._create_non_slot_variable(initial_value=1.0, name="step", colocate_with=first_var)
+
+        for v in var_list:
+            shape = v.get_shape()
+            if v not in getattr(self, "_sparse_vars", ()) or shape.ndims is None or shape.ndims == 0:
+                continue
+            self._get_or_make_slot_with_initializer(v, tf.zeros_initializer(), shape[:1],
+                                                    tf.float32, "last_step", self._name)
+
+    def _get_step(self):
+        return self._get_non_slot_variable("step", graph=tf.get_default_graph())
+
+    def _apply_sparse(self, grad, var):
+        # the base class has already summed the values of any repeated
+        # indices, so each row appears once here.
+        idxs = grad.indices
+        g = grad.values
+
+        beta1_power, beta2_power = self._get_beta_accumulators()
+        beta1 = tf.cast(self._beta1_t, var.dtype.base_dtype)
+        beta2 = tf.cast(self._beta2_t, var.dtype.base_dtype)
+        epsilon = tf.cast(self._epsilon_t, var.dtype.base_dtype)
+        lr = tf.cast(self._lr_t, var.dtype.base_dtype) * tf.sqrt(1 - beta2_power) / (1 - beta1_power)
+
+        m = self.get_slot(var, "m")
+        v = self.get_slot(var, "v")
+        last_step = self.get_slot(var, "last_step")
+        step = self._get_step()
+
+        # decay each row's moments for the steps since it was last updated
+        skipped = step - 1 - tf.gather(last_step, idxs)
+        skipped = tf.reshape(skipped, [-1,] + [1,] * (g.get_shape().ndims - 1))
+        m_row = tf.gather(m, idxs) * tf.pow(beta1, skipped)
+        v_row = tf.gather(v, idxs) * tf.pow(beta2, skipped)
+
+        m_row = beta1 * m_row + (1 - beta1) * g
+        v_row = beta2 * v_row + (1 - beta2) * tf.square(g)
+
+        m_update = tf.scatter_update(m, idxs, m_row, use_locking=self._use_locking)
+        v_update = tf.scatter_update(v, idxs, v_row, use_locking=self._use_locking)
+        step_update = tf.scatter_update(last_step, idxs, tf.fill(tf.shape(idxs), step), use_locking=self._use_locking)
+        var_update = tf.scatter_sub(var, idxs, lr * m_row / (tf.sqrt(v_row) + epsilon), use_locking=self._use_locking)
+        return tf.group(var_update, m_update, v_update, step_update)
+
+    def _finish(self, update_ops, name_scope):
+        with tf.control_dependencies(update_ops):
+            step = self._get_step()
+            with tf.colocate_with(step):
+                update_step = step.assign_add(1.0, use_locking=self._use_locking)
+        return super(LazyAdamOptimizer, self)._finish(update_ops + [update_step], name_scope)
@@ -2,10 +2,56 @@ import numpy as np
 import tensorflow as tf
 import elbow.util as util
 
+from elbow.util.misc import concrete_shape
+
 from elbow.elementary import Gaussian
-from elbow.conditional_dist import ConditionalDistribution
+from elbow.conditional_dist import ConditionalDistribution, WrapperNode
 from elbow.parameterization import unconstrained, positive_exp, simplex_constrained
 
+def noise_shape(shape, noise="scalar"):
+    """
+    Shape of a noise std for an N x M result, shared by all entries
+    ("scalar"), by the entries of each row ("row") or of each column
+    ("col"), or separate for every entry ("full"). The density code
+    broadcasts the compact shapes against the result.
+    """
+    N, M = shape
+    shapes = {"scalar": (1, 1), "row": (N, 1), "col": (1, M), "full": (N, M)}
+    if noise not in shapes:
+        raise Exception("unrecognized noise parameterization %s, expected one of %s" % (noise, sorted(shapes.keys())))
+    return shapes[noise]
+
+def _full_variance(q):
+    # Q distributions with a compact noise std report a compact
+    # variance; expand it to the shape of the mean where we need
+    # per-entry values (e.g. to multiply or gather rows of factors).
+    if q.variance.get_shape().as_list() == q.mean.get_shape().as_list():
+        return q.variance
+    return q.variance * tf.ones_like(q.mean)
+
+def _squared_norms(x, axis):
+    # sums of squares of x along an axis. if x is a constant (e.g. 
+    # data given to observe()) we compute them once here, rather than
+    # squaring all of x at every training step.
+    value = tf.contrib.util.constant_value(x)
+    if value is not None:
+        return tf.constant(np.sum(np.square(value), axis=axis), dtype=x.dtype)
+    return tf.reduce_sum(tf.square(x), axis)
+
+def _gather_cells(x, rows, cols):
+    # the entries (rows[i], cols[i]) of x, broadcast as if x had the
+    # full shape of the result (x may be a scalar, a row or column 
+    # vector, or a full matrix). 
+    x = tf.convert_to_tensor(x)
+    shape = x.get_shape().as_list()
+    if len(shape) == 0:
+        return x
+    if len(shape) == 1:
+        return x if shape[0] == 1 else tf.gather(x, cols)
+    row_idxs = rows if shape[0] != 1 else tf.zeros_like(rows)
+    col_idxs = cols if shape[1] != 1 else tf.zeros_like(cols)
+    return tf.gather_nd(x, tf.stack([row_idxs, col_idxs], axis=1))
+
 class NoisyGaussianMatrixProduct(ConditionalDistribution):
     
     def __init__(self, A, B,
@@ -13,20 +59,65 @@ class NoisyGaussianMatrixProduct(ConditionalDistribution):
                  rescale=False,
                  inference_weights=None,
                  scale_logp=1,
-                 mask=None, **kwargs):
+                 mask=None,
+                 q_noise="scalar", **kwargs):
 
         # optionally compute (AB' / K) instead of AB',
         # so that the marginal variance of the result equals
         # the marginal variance of the inputs
         self.rescale = rescale
-        self.K = A.shape[1]
+        self.K = int(A.shape[1])
 
+        # a mask given as a tf.SparseTensor, as a tuple (rows, cols) of
+        # index arrays, or as a mostly-zero numpy array, is applied by
+        # computing only the observed entries of the product.
         self.mask = mask
+        self.mask_cells = self._sparse_mask(mask)
+        # shape of the noise std in the default Q distribution, see noise_shape
+        self.q_noise = q_noise
         self.scale_logp = scale_logp
         self.inference_weights = inference_weights
         
         super(NoisyGaussianMatrixProduct, self).__init__(A=A, B=B, std=std,  **kwargs) 
         
+    # dense numpy masks with at most this fraction of nonzero entries
+    # take the sparse path
+    sparse_mask_density = 0.1
+    
+    def _sparse_mask(self, mask):
+        """
+        Return (rows, cols, weights) tensors for the nonzero entries 
+        of a sparse mask, or None if the mask should be applied densely.
+        """
+        if mask is None:
+            return None
+        if isinstance(mask, tf.SparseTensor):
+            rows = tf.cast(mask.indices[:, 0], tf.int32)
+            cols = tf.cast(mask.indices[:, 1], tf.int32)
+            return rows, cols, tf.cast(mask.values, tf.float32)
+        if isinstance(mask, tuple):
+            rows, cols = mask
+            rows = tf.constant(np.int32(rows))
+            cols = tf.constant(np.int32(cols))
+            return rows, cols, tf.ones(tf.shape(rows), dtype=tf.float32)
+        if isinstance(mask, np.ndarray) and np.count_nonzero(mask) <= self.sparse_mask_density * mask.size:
+            rows, cols = np.nonzero(mask)
+            weights = np.float32(mask[rows, cols])
+            return tf.constant(np.int32(rows)), tf.constant(np.int32(cols)), tf.constant(weights)
+        return None
+
+    def _dense_mask(self):
+        # the mask as an N x M matrix, for the inference network.
+        # weights of a tuple mask are implicitly one
+        if isinstance(self.mask, tuple):
+            rows, cols = self.mask
+            mask = np.zeros(self.shape, dtype=np.float32)
+            mask[rows, cols] = 1.0
+            return mask
+        if isinstance(self.mask, tf.SparseTensor):
+            return tf.sparse_tensor_to_dense(self.mask, validate_indices=False)
+        return self.mask
+    
     def inputs(self):
         return {"A": unconstrained, "B": unconstrained, "std": positive_exp}
 
@@ -55,6 +146,15 @@ class NoisyGaussianMatrixProduct(ConditionalDistribution):
         return eps * std + prod
 
     def _logp(self, result, A, B, std):
+        if self.mask_cells is not None:
+            rows, cols, weights = self.mask_cells
+            prod = tf.reduce_sum(tf.gather(A, rows) * tf.gather(B, cols), 1)
+            if self.rescale:
+                prod = prod / np.sqrt(self.K)
+            lps = util.dists.gaussian_log_density(_gather_cells(result, rows, cols), mean=prod,
+                                                  stddev=_gather_cells(std, rows, cols))
+            return tf.reduce_sum(lps * weights) * self.scale_logp
+        
         prod = tf.matmul(A, tf.transpose(B))
         if self.rescale:
             prod = prod / np.sqrt(self.K)
@@ -73,15 +173,26 @@ class NoisyGaussianMatrixProduct(ConditionalDistribution):
         std = q_std._sampled if q_std is not None else self.inputs_nonrandom['std']
         
         try:
-            var = q_result.variance + tf.square(std)
-            mA, vA = q_A.mean, q_A.variance
-            mB, vB = q_B.mean, q_B.variance
+            if isinstance(q_result, WrapperNode):
+                # observed: the result has no variance, and we avoid
+                # materializing the wrapper's N x M zeros
+                var = tf.square(std)
+            else:
+                var = q_result.variance + tf.square(std)
+            mA, vA = q_A.mean, _full_variance(q_A)
+            mB, vB = q_B.mean, _full_variance(q_B)
         except:
             # if any Q dists are missing or nongaussian
             A = q_A._sampled if q_A is not None else self.inputs_nonrandom['A']
             B = q_B._sampled if q_B is not None else self.inputs_nonrandom['B']
             return self._logp(result=q_result._sampled, A=A, B=B, std=std)
-            
+
+        if self.mask_cells is not None:
+            return self._sparse_expected_logp(q_result.mean, var, mA, vA, mB, vB) * self.scale_logp
+        if self.mask is None:
+            noise_axis = self._noise_axis(var)
+            if noise_axis is not None:
+                return self._factored_expected_logp(q_result.mean, var, mA, vA, mB, vB, noise_axis) * self.scale_logp
         expected_result = tf.matmul(mA, tf.transpose(mB))
         if self.rescale:
             expected_result = expected_result / np.sqrt(self.K)
@@ -92,13 +203,6 @@ class NoisyGaussianMatrixProduct(ConditionalDistribution):
         else:
             gaussian_lp = tf.reduce_sum(gaussian_lps)
             
-        # can do a more efficient calculation if we assume a uniform (scalar) noise variance across all entries
-        #aat_diag = tf.reduce_sum(tf.square(mA), 0)
-        #p = tf.reduce_sum(vA, 0)
-        #btb_diag = tf.reduce_sum(tf.square(mB), 0)
-        #q = tf.reduce_sum(vB, 0)
-        #correction = tf.reduce_sum(p*q + p*btb_diag + aat_diag*q) / scalar_variance
-
         vAvB = tf.matmul(vA, tf.transpose(vB))
         vAmB = tf.matmul(vA, tf.transpose(tf.square(mB)))
         mAvB = tf.matmul(tf.square(mA), tf.transpose(vB))
@@ -119,6 +223,84 @@ class NoisyGaussianMatrixProduct(ConditionalDistribution):
         return expected_lp * self.scale_logp
 
 
+    def _sparse_expected_logp(self, X, var, mA, vA, mB, vB):
+        """
+        The masked expected log density, computed only at the nonzero
+        entries of the mask from the gathered rows of the factors. 
+        """
+        rows, cols, weights = self.mask_cells
+        mA, vA = tf.gather(mA, rows), tf.gather(vA, rows)
+        mB, vB = tf.gather(mB, cols), tf.gather(vB, cols)
+        var = _gather_cells(var, rows, cols)
+
+        expected_result = tf.reduce_sum(mA * mB, 1)
+        if self.rescale:
+            expected_result = expected_result / np.sqrt(self.K)
+        gaussian_lps = util.dists.gaussian_log_density(_gather_cells(X, rows, cols), expected_result, variance=var)
+
+        correction = tf.reduce_sum(vA*vB + vA*tf.square(mB) + tf.square(mA)*vB, 1) / var
+        if self.rescale:
+            correction = correction / (self.K)
+        return tf.reduce_sum((gaussian_lps - .5 * correction) * weights)
+        
+    def _noise_axis(self, var):
+        """
+        If the noise variance is constant along the rows (a scalar or
+        per-column variance) return 1, if it's constant along the 
+        columns (per-row variance) return 0, otherwise None. 
+        """
+        N, M = self.shape
+        shape = var.get_shape().as_list()
+        if all(d == 1 for d in shape):
+            return 0
+        if shape == [N, 1]:
+            return 0
+        if shape == [M] or shape == [1, M]:
+            return 1
+        return None
+
+    def _factored_expected_logp(self, X, var, mA, vA, mB, vB, noise_axis):
+        """
+        The expected log density of a fully observed X under a noise 
+        variance shared across rows or columns, computed from K x K 
+        and (N or M) x K terms without building the N x M product 
+        mA mB' or its variance: the squared error ||X - mA mB'||^2 of 
+        each row expands to 
+            ||X_i||^2 - 2 (X mB)_i . mA_i + mA_i' (mB'mB) mA_i
+        (and symmetrically for columns), and the variance correction
+        sums over columns of vA vB' + vA mB^2' + mA^2 vB' reduce to 
+        column sums of vB, mB^2. The norms ||X_i||^2 are computed once
+        if X is a constant; if it's fed (e.g. through a placeholder) 
+        they take one pass over X per step. 
+        """
+        N, M = self.shape
+        
+        transpose_X = (noise_axis == 1)
+        if transpose_X:
+            # per-column noise: the same computation on the transpose
+            mA, vA, mB, vB = mB, vB, mA, vA
+            N, M = M, N
+
+        # per-row variances (a scalar variance broadcasts here)
+        row_var = tf.reshape(var, [-1]) * tf.ones((N,), dtype=tf.float32)
+        
+        scale = 1.0 / np.sqrt(self.K) if self.rescale else 1.0
+        mBs = mB * scale
+
+        sq_X = _squared_norms(X, 0 if transpose_X else 1)
+        cross = tf.reduce_sum(tf.matmul(X, mBs, transpose_a=transpose_X) * mA, 1)
+        quad = tf.reduce_sum(tf.matmul(mA, tf.matmul(mBs, mBs, transpose_a=True)) * mA, 1)
+        squared_error = sq_X - 2*cross + quad
+        
+        vB_sum = tf.reduce_sum(vB, 0)
+        mB2_sum = tf.reduce_sum(tf.square(mB), 0)
+        correction = tf.reduce_sum(vA * (vB_sum + mB2_sum) + tf.square(mA) * vB_sum, 1)
+        if self.rescale:
+            correction = correction / (self.K)
+
+        lps = -0.5 * (squared_error + correction) / row_var - .5 * M * tf.log(2*np.pi * row_var)
+        return tf.reduce_sum(lps)
+    
     def default_q(self):
         if "A" in self.inputs_random:
             q_A = self.inputs_random["A"].q_distribution()
@@ -130,7 +312,7 @@ class NoisyGaussianMatrixProduct(ConditionalDistribution):
         else:
             q_B = self.inputs_nonrandom["B"]
 
-        std = positive_exp(shape=self.shape)
+        std = positive_exp(shape=noise_shape(self.shape, self.q_noise))
         return NoisyGaussianMatrixProduct(A=q_A, B=q_B, std=std,
                                           rescale=self.rescale,
                                           shape=self.shape, name="q_"+self.name)
@@ -148,7 +330,7 @@ class NoisyGaussianMatrixProduct(ConditionalDistribution):
         assert(n_traits == n_traits2)
         
         observed_ratings = q_result._sampled
-        mask = self.mask
+        mask = self._dense_mask()
         means, stds, weights = build_trait_network(observed_ratings,
                                                    mask,
                                                    n_traits=n_traits,
@@ -161,28 +343,94 @@ class NoisyGaussianMatrixProduct(ConditionalDistribution):
 
     
 class NoisySparseGaussianMatrixProduct(ConditionalDistribution):
+    """
+    Observations of the entries (row_idxs[i], col_idxs[i]) of a noisy
+    low-rank product AB'. 
+
+    For stochastic variational inference on large matrices, pass 
+    batch_size instead of fixed indices: the node then models a 
+    minibatch of batch_size entries whose indices and values are fed
+    through placeholders, e.g. 
+        R = NoisySparseGaussianMatrixProduct(A, B, std, batch_size=1000)
+        jm = Model(R)
+        jm.register_feed(R.observe_minibatches(rows, cols, values))
+    so that each step costs O(batch_size * K) regardless of the number
+    of observed entries. The likelihood of each minibatch is scaled up 
+    by n_observed / batch_size, which is fixed once the ELBO is built, 
+    so observe_minibatches must come first; alternatively pass 
+    n_observed (the number of observed entries) to the constructor. 
+    """
     
-    def __init__(self, A, B, std=None, row_idxs=None, col_idxs=None, batch_mask=None, rescale=False, **kwargs):
+    def __init__(self, A, B, std=None, row_idxs=None, col_idxs=None, batch_mask=None, rescale=False,
+                 batch_size=None, n_observed=None, scale_logp=1, **kwargs):
 
         # optionally compute (AB' / K) instead of AB',
         # so that the marginal variance of the result equals
         # the marginal variance of the inputs
         self.rescale = rescale
-        self.K = A.shape[1]
-
+        self.K = int(A.shape[1])
+        if n_observed is not None and batch_size is not None:
+            scale_logp = n_observed / float(batch_size)
+        self.scale_logp = scale_logp
+        # set once the expected log density (and thus the ELBO) has
+        # been built with the current scale
+        self._scale_logp_used = False
+
+        self.batch_size = batch_size
+        if batch_size is not None:
+            row_idxs = tf.placeholder(dtype=tf.int32, shape=(batch_size,), name="row_idxs")
+            col_idxs = tf.placeholder(dtype=tf.int32, shape=(batch_size,), name="col_idxs")
+        
         if batch_mask is None:
             # default to the trivial mask
-            batch_mask = np.ones(row_idxs.shape, dtype=np.float32)
+            batch_mask = np.ones(concrete_shape(row_idxs.shape), dtype=np.float32)
 
         super(NoisySparseGaussianMatrixProduct, self).__init__(A=A, B=B, std=std, row_idxs=row_idxs, col_idxs=col_idxs, batch_mask=batch_mask, **kwargs) 
         
     def inputs(self):
         return {"A": unconstrained, "B": unconstrained, "std": positive_exp, "row_idxs": None, "col_idxs": None, "batch_mask": None}
 
+    def observe_minibatches(self, row_idxs, col_idxs, values):
+        """
+        Observe the entries values[i] at (row_idxs[i], col_idxs[i]) 
+        through random minibatches of batch_size of them. The 
+        likelihood is scaled by the ratio of observed entries to batch
+        size, so it's an unbiased estimate of the full-data likelihood.
+        Returns a callable producing a feed dict for a new minibatch, 
+        to pass to Model.register_feed. 
+        """
+        if self.batch_size is None:
+            raise Exception("observe_minibatches requires a node constructed with batch_size")
+
+        n_observed = len(values)
+        scale_logp = n_observed / float(self.batch_size)
+        if scale_logp != self.scale_logp:
+            if self._scale_logp_used:
+                raise Exception("the likelihood of %s was already built with scale %s; call observe_minibatches before building the ELBO, or pass n_observed=%d to the constructor" % (self, self.scale_logp, n_observed))
+            self.scale_logp = scale_logp
+        values_placeholder = self.observe_placeholder()
+        row_placeholder = self.inputs_nonrandom["row_idxs"]
+        col_placeholder = self.inputs_nonrandom["col_idxs"]
+        
+        def feed():
+            batch = np.random.randint(n_observed, size=self.batch_size)
+            return {row_placeholder: row_idxs[batch],
+                    col_placeholder: col_idxs[batch],
+                    values_placeholder: values[batch]}
+        return feed
+
+    def _gather_rows(self, params, idxs):
+        # minibatches often repeat rows or columns, so we gather each
+        # distinct row once from the (large) parameter matrices and 
+        # expand from there. This also keeps the gradient with respect
+        # to each parameter matrix down to one slice per distinct row. 
+        unique_idxs, positions = tf.unique(idxs)
+        return [tf.gather(tf.gather(p, unique_idxs), positions) for p in params]
+    
     def derived_parameters(self, A, B, std, row_idxs, col_idxs, **kwargs):
         derived = {}
-        Aidx = tf.gather(A, row_idxs)
-        Bidx = tf.gather(B, col_idxs)
+        Aidx, = self._gather_rows([A], row_idxs)
+        Bidx, = self._gather_rows([B], col_idxs)
         prod = tf.reduce_sum(Aidx * Bidx, 1)
 
         if self.rescale:
@@ -207,8 +455,8 @@ class NoisySparseGaussianMatrixProduct(ConditionalDistribution):
     def _sample(self, A, B, std, row_idxs, col_idxs, batch_mask):
         eps = tf.random_normal(shape=self.shape, dtype=self.dtype)
 
-        Aidx = tf.gather(A, row_idxs)
-        Bidx = tf.gather(B, col_idxs)
+        Aidx, = self._gather_rows([A], row_idxs)
+        Bidx, = self._gather_rows([B], col_idxs)
         prod = tf.reduce_sum(Aidx * Bidx, 1)
         
         if self.rescale:
@@ -218,18 +466,19 @@ class NoisySparseGaussianMatrixProduct(ConditionalDistribution):
 
     def _logp(self, result, A, B, std, row_idxs, col_idxs, batch_mask):
 
-        Aidx = tf.gather(A, row_idxs)
-        Bidx = tf.gather(B, col_idxs)
+        Aidx, = self._gather_rows([A], row_idxs)
+        Bidx, = self._gather_rows([B], col_idxs)
         prod = tf.reduce_sum(Aidx * Bidx, 1)
         if self.rescale:
             prod = prod / np.sqrt(self.K)
 
         lps = util.dists.gaussian_log_density(result, mean=prod, stddev=std)
         lp = tf.reduce_sum(lps * batch_mask)
-        return lp
+        return lp * self.scale_logp
 
     def _expected_logp(self, q_result, q_A=None, q_B=None, q_std=None, q_row_idxs=None, q_col_idxs=None, q_batch_mask=None):
 
+        self._scale_logp_used = True
         std = q_std._sampled if q_std is not None else self.inputs_nonrandom['std']
         row_idxs = q_row_idxs._sampled if q_row_idxs is not None else self.inputs_nonrandom['row_idxs']
         col_idxs = q_col_idxs._sampled if q_col_idxs is not None else self.inputs_nonrandom['col_idxs']
@@ -237,8 +486,8 @@ class NoisySparseGaussianMatrixProduct(ConditionalDistribution):
 
         try:
             var = q_result.variance + tf.square(std)
-            mA, vA = tf.gather(q_A.mean, row_idxs), tf.gather(q_A.variance, row_idxs)
-            mB, vB = tf.gather(q_B.mean, col_idxs), tf.gather(q_B.variance, col_idxs)
+            mA, vA = self._gather_rows([q_A.mean, _full_variance(q_A)], row_idxs)
+            mB, vB = self._gather_rows([q_B.mean, _full_variance(q_B)], col_idxs)
         except Exception as e:
             # if any Q dists are missing or nongaussian
             print("devolving to stochastic logp", e)
@@ -265,7 +514,7 @@ class NoisySparseGaussianMatrixProduct(ConditionalDistribution):
         
         expected_lp = gaussian_lp - .5 * correction
         
-        return expected_lp
+        return expected_lp * self.scale_logp
 
     def _hack_symmetry_correction(self):
         # TODO replace this with the correct area for the Stiefel manifold
@@ -273,41 +522,114 @@ class NoisySparseGaussianMatrixProduct(ConditionalDistribution):
         signflip_correction = self.K * np.log(2)
         return permutation_correction + signflip_correction
 
-class BatchDenseGeneratorByUser(object):
+class CSRRows(object):
+    """
+    Sparse rows (e.g. each user's item ids and ratings) in compressed 
+    sparse row form: the column ids and values of row i are 
+    indices[indptr[i]:indptr[i+1]] and values[indptr[i]:indptr[i+1]]. 
 
+    save() writes a compact binary file (a short header followed by 
+    the raw indptr, indices and values arrays), which load() maps into
+    memory without reading it, so it can be larger than RAM. 
+    """
+
+    MAGIC = b"ELBOCSR1"
+    
+    def __init__(self, indptr, indices, values, n_cols):
+        self.indptr = indptr
+        self.indices = indices
+        self.values = values
+        self.n_cols = n_cols
+        self.n_rows = len(indptr) - 1
+
+    @staticmethod
+    def from_rows(rows, n_cols):
+        """Build from a list of (column ids, values) pairs, one per row."""
+        lengths = np.array([len(cols) for (cols, vals) in rows], dtype=np.int64)
+        indptr = np.zeros(len(rows)+1, dtype=np.int64)
+        np.cumsum(lengths, out=indptr[1:])
+        indices = np.concatenate([np.asarray(cols, dtype=np.int32) for (cols, vals) in rows] + [np.zeros(0, dtype=np.int32)])
+        values = np.concatenate([np.asarray(vals, dtype=np.float32) for (cols, vals) in rows] + [np.zeros(0, dtype=np.float32)])
+        return CSRRows(indptr, indices, values, n_cols)
+
+    def save(self, path):
+        header = np.array([self.n_rows, self.n_cols, len(self.indices)], dtype="<i8")
+        with open(path, "wb") as f:
+            f.write(self.MAGIC)
+            f.write(header.tobytes())
+            f.write(np.asarray(self.indptr, dtype="<i8").tobytes())
+            f.write(np.asarray(self.indices, dtype="<i4").tobytes())
+            f.write(np.asarray(self.values, dtype="<f4").tobytes())
+
+    @staticmethod
+    def load(path):
+        with open(path, "rb") as f:
+            if f.read(len(CSRRows.MAGIC)) != CSRRows.MAGIC:
+                raise Exception("%s is not a CSR rows file" % path)
+            n_rows, n_cols, nnz = np.frombuffer(f.read(24), dtype="<i8")
+            
+        offset = len(CSRRows.MAGIC) + 24
+        indptr = np.memmap(path, dtype="<i8", mode="r", offset=offset, shape=(n_rows+1,))
+        offset += 8 * (n_rows+1)
+        indices = np.memmap(path, dtype="<i4", mode="r", offset=offset, shape=(nnz,))
+        offset += 4 * nnz
+        values = np.memmap(path, dtype="<f4", mode="r", offset=offset, shape=(nnz,))
+        return CSRRows(indptr, indices, values, int(n_cols))
+    
+class BatchDenseGeneratorByUser(object):
+    """
+    Dense ratings and mask matrices of shape (batch_size_users, n_items)
+    for successive batches of users, in a random order reshuffled each
+    epoch. user_rows is either a list of (item ids, ratings) pairs, one
+    per user, or a CSRRows (e.g. from CSRRows.load). 
+
+    The returned arrays are reused across calls; each batch clears 
+    only the cells the previous one set. 
+    """
+    
     def __init__(self, user_rows, n_items,
                  batch_size_users,
                  shuffle=True):
+        if not isinstance(user_rows, CSRRows):
+            user_rows = CSRRows.from_rows(user_rows, n_items)
         self.user_rows = user_rows
         self.n_items = n_items
         self.batch_size_users = batch_size_users
         
-        self.n_users = len(user_rows)
+        self.n_users = user_rows.n_rows
         self.idx = 0
 
         self.batch_mask = np.zeros((batch_size_users,n_items), dtype=np.float32)
         self.ratings = np.zeros((batch_size_users,n_items), dtype=np.float32)
-
-        self.shuffled_rows = user_rows
+        self.touched = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+        
+        self.order = np.arange(self.n_users)
         self.shuffle = shuffle
         self.flag_reshuffle = shuffle
         
     def next_batch(self):        
         if self.flag_reshuffle:
-            self.shuffled_rows = [self.user_rows[i] for i in \
-                                  np.random.permutation(self.n_users)]
+            self.order = np.random.permutation(self.n_users)
             self.idx = 0
             self.flag_reshuffle = False
-            
-        self.ratings[:,:] = 0
-        self.batch_mask[:,:] = 0
-        for relative_uid in range(self.batch_size_users):
-            current_idx = (self.idx + relative_uid) % self.n_users
-            mids_user, ratings_user = self.shuffled_rows[current_idx]
-            
-            self.ratings[relative_uid, mids_user] = ratings_user
-            self.batch_mask[relative_uid, mids_user] = 1
 
+        users = self.order[(self.idx + np.arange(self.batch_size_users)) % self.n_users]
+
+        # positions in the CSR arrays of every rating in the batch: 
+        # the concatenation of ranges indptr[u]:indptr[u+1]. 
+        starts = np.asarray(self.user_rows.indptr[users])
+        lengths = np.asarray(self.user_rows.indptr[users+1]) - starts
+        offsets = np.cumsum(lengths) - lengths
+        positions = np.arange(np.sum(lengths)) + np.repeat(starts - offsets, lengths)
+        
+        rows = np.repeat(np.arange(self.batch_size_users), lengths)
+        cols = np.asarray(self.user_rows.indices[positions])
+        
+        self.ratings[self.touched] = 0
+        self.batch_mask[self.touched] = 0
+        self.ratings[rows, cols] = self.user_rows.values[positions]
+        self.batch_mask[rows, cols] = 1
+        self.touched = (rows, cols)
             
         current_idx = self.idx + self.batch_size_users
         if current_idx > self.n_users:
@@ -377,7 +699,8 @@ def build_trait_network(sparse_ratings, mask, n_traits, weights=None):
     
 class NoisyCumulativeSum(ConditionalDistribution):
     
-    def __init__(self, A, std,  **kwargs):
+    def __init__(self, A, std, q_noise="scalar", **kwargs):
+        self.q_noise = q_noise
         super(NoisyCumulativeSum, self).__init__(A=A, std=std,  **kwargs)      
         
     def inputs(self):
@@ -396,7 +719,7 @@ class NoisyCumulativeSum(ConditionalDistribution):
 
         try:
             A_mean = q_A.mean
-            A_variance = q_A.variance
+            A_variance = _full_variance(q_A)
 
             var = q_result.variance + tf.square(std)
             X = q_result.mean
@@ -414,9 +737,15 @@ class NoisyCumulativeSum(ConditionalDistribution):
 
         # performs a reverse cumulative sum
         #R = tf.matmul(cumsum_mat, 1.0/var, transpose_a=True)        
-        rvar = tf.reverse(1.0/var, [False, True])
-        R = tf.reverse(tf.cumsum(rvar, axis=1), [False, True])
-        corrections = -.5 * R * q_A.variance
+        if var.get_shape().as_list()[-1:] == [1]:
+            # variance shared across each row: the reverse cumsum
+            # is just a count of the remaining columns
+            N, D = self.shape
+            R = np.float32(np.arange(D, 0, -1)).reshape((1, -1)) / var
+        else:
+            rvar = tf.reverse(1.0/var, [False, True])
+            R = tf.reverse(tf.cumsum(rvar, axis=1), [False, True])
+        corrections = -.5 * R * A_variance
 
         reduced_gaussian_lp =  tf.reduce_sum(gaussian_lp) 
         reduced_correction = tf.reduce_sum(corrections)
@@ -443,7 +772,7 @@ class NoisyCumulativeSum(ConditionalDistribution):
         else:
             q_A = self.inputs_nonrandom["A"]
 
-        std = positive_exp(shape=self.shape)
+        std = positive_exp(shape=noise_shape(self.shape, self.q_noise))
         return NoisyCumulativeSum(A=q_A, std=std, shape=self.shape, name="q_"+self.name)
 
     def _inference_networks(self, q_result):
@@ -497,8 +826,9 @@ class CumsumInference(ConditionalDistribution):
         
 class GMMClustering(ConditionalDistribution):
 
-    def __init__(self, weights, centers, std, **kwargs):
+    def __init__(self, weights, centers, std, q_noise="scalar", **kwargs):
         self.n_clusters = centers.shape[0]
+        self.q_noise = q_noise
         super(GMMClustering, self).__init__(weights=weights, centers=centers, std=std, **kwargs)
         
     def inputs(self):
@@ -548,7 +878,7 @@ class GMMClustering(ConditionalDistribution):
         else:
             q_centers = self.inputs_nonrandom["centers"]
 
-        std = positive_exp(shape=self.shape)
+        std = positive_exp(shape=noise_shape(self.shape, self.q_noise))
         return GMMClustering(weights=q_weights, centers=q_centers, std=std, shape=self.shape, name="q_"+self.name)
 
     def _hack_symmetry_correction(self):
@@ -587,6 +917,10 @@ class NoisyLatentFeatures(ConditionalDistribution):
     def _sample(self, B, G, std):
         eps = tf.random_normal(shape=self.shape, dtype=self.dtype)        
         return tf.matmul(B, G) + eps*std
+
+    def _logp(self, result, B, G, std):
+        lps = util.dists.gaussian_log_density(result, mean=tf.matmul(B, G), stddev=std)
+        return tf.reduce_sum(lps)
     
     def _expected_logp(self, q_result, q_B, q_G, q_std=None):
         """ 
@@ -612,16 +946,21 @@ class NoisyLatentFeatures(ConditionalDistribution):
         """
 
         std = q_std._sampled if q_std is not None else self.inputs_nonrandom["std"]
-        var = q_result.variance + tf.square(std)
-        X_means = q_result.mean
-        bernoulli_params = q_B.p
+        try:
+            var = q_result.variance + tf.square(std)
+            X_means = q_result.mean
+            bernoulli_params = q_B.p
+            mG = q_G.mean
+        except AttributeError:
+            # if the Q dists are not Gaussian (X, G) and Bernoulli (B)
+            return self._logp(result=q_result._sampled, B=q_B._sampled, G=q_G._sampled, std=std)
         
-        expected_X = tf.matmul(bernoulli_params, q_G.mean)
+        expected_X = tf.matmul(bernoulli_params, mG)
         precisions = 1.0/var
         gaussian_lp = util.dists.gaussian_log_density(X_means, expected_X, variance=var)
 
-        mu2 = tf.square(q_G.mean)
-        tau_V = tf.matmul(bernoulli_params, q_G.variance)
+        mu2 = tf.square(mG)
+        tau_V = tf.matmul(bernoulli_params, _full_variance(q_G))
         tau_tau2_mu2 = tf.matmul(bernoulli_params - tf.square(bernoulli_params), mu2)
         tmp = tau_V + tau_tau2_mu2
         lp_correction = tmp * precisions
@@ -676,3 +1015,6 @@ class MultiplicativeGaussianNoise(ConditionalDistribution):
         lp = tf.reduce_sum(util.dists.gaussian_log_density(residuals, 0.0, std))
         return lp
 
+    def default_q(self):
+        return Gaussian(shape=self.shape, name="q_"+self.name)
+
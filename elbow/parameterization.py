@@ -7,6 +7,23 @@ from elbow.transforms import Simplex, Logit
 Utility methods for defining constrained variables as transforms of an unconstrained parameterization. 
 """
 
+# each transformed parameter records how it's computed from its
+# underlying variables, so that a training loop can recompute it from
+# their current values at every step (see Model._get_train_loop)
+PARAMETER_BUILDS = "elbow_parameter_builds"
+
+def _parameter(build, *variables):
+    value = build(*variables)
+    tf.add_to_collection(PARAMETER_BUILDS, (value, build, variables))
+    return value
+
+def parameter_builds(graph):
+    """
+    Map each transformed parameter in graph to the (build, variables)
+    that compute it, i.e. value = build(*variables). 
+    """
+    return {value: (build, variables) for (value, build, variables) in graph.get_collection(PARAMETER_BUILDS)}
+
 def unconstrained(shape=None, init=None, name=None):
 
     if init is None:
@@ -36,7 +53,7 @@ def unconstrained_scale(shape=None, name=None):
     
     val = tf.Variable(init, name=name)
     scale = tf.Variable(np.float32(1e-6), name=name)
-    return val * scale
+    return _parameter(lambda val, scale: val * scale, val, scale)
 
 
 def simplex_constrained(shape=None, init_log=None, name=None):
@@ -46,7 +63,7 @@ def simplex_constrained(shape=None, init_log=None, name=None):
         init_log = np.float32(np.random.randn(*shape))
 
     log_value = tf.Variable(init_log, name= "log_"+name if name is not None else None)
-    return Simplex.transform(log_value)
+    return _parameter(Simplex.transform, log_value)
 
 def unit_interval(shape=None, init_log=None, name=None):
     # Defines a matrix each element of which is in the unit interval.
@@ -58,7 +75,7 @@ def unit_interval(shape=None, init_log=None, name=None):
         init_log = np.float32(np.random.randn(*shape))
 
     log_value = tf.Variable(init_log, name= "log_"+name if name is not None else None)
-    return Logit.transform(log_value)
+    return _parameter(Logit.transform, log_value)
 
 def positive_exp(shape=None, init_log=None, name=None):
     # a Tensor of values that are pointwise positive, represented by an exponential
@@ -68,7 +85,7 @@ def positive_exp(shape=None, init_log=None, name=None):
         init_log = np.float32(np.ones(shape) * -10)
     
     log_value = tf.Variable(init_log, name= "log_"+name if name is not None else None)
-    pos_value = tf.exp(tf.clip_by_value(log_value, -42, 42), name=name)
+    pos_value = _parameter(lambda log_value: tf.exp(tf.clip_by_value(log_value, -42, 42), name=name), log_value)
     return pos_value
 
 def psd_matrix(shape=None, init=None, name=None):
@@ -80,7 +97,7 @@ def psd_matrix(shape=None, init=None, name=None):
     
     
     A = tf.Variable(init, name="latent_"+name if name is not None else None)
-    psd = tf.matmul(tf.transpose(A), A, name=name)
+    psd = _parameter(lambda A: tf.matmul(tf.transpose(A), A, name=name), A)
     return psd
 
 def psd_matrix_small(shape=None, init=None, name=None):
@@ -91,7 +108,7 @@ def psd_matrix_small(shape=None, init=None, name=None):
     # TODO figure out lower triangular parameterization
     
     A = tf.Variable(init, name="latent_"+name if name is not None else None)
-    psd = tf.matmul(tf.transpose(A), A, name=name)
+    psd = _parameter(lambda A: tf.matmul(tf.transpose(A), A, name=name), A)
     return psd
 
 def psd_diagonal(shape=None, init=None, name=None):
@@ -101,7 +118,7 @@ def psd_diagonal(shape=None, init=None, name=None):
     init = np.float32(np.zeros(n))
     
     latent_diag = tf.Variable(init, name="latent_"+name if name is not None else None)
-    psd = tf.diag(tf.exp(latent_diag), name=name)
+    psd = _parameter(lambda latent_diag: tf.diag(tf.exp(latent_diag), name=name), latent_diag)
     return psd
 
 def orthogonal_columns(shape=None, name=None, normalize=False, sort_columns=False, separate_norms=False):
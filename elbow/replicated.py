@@ -0,0 +1,160 @@
+from __future__ import print_function
+import numpy as np
+import tensorflow as tf
+
+import copy
+import time
+
+from elbow.conditional_dist import ConditionalDistribution
+from elbow.joint_model import Model, StepCountStopper, MovingAverageStopper
+from elbow.lazy_adam import LazyAdamOptimizer
+
+class ReplicatedModel(object):
+    """
+    Trains many independent copies (replicas) of a model as a single
+    batched graph, e.g. random restarts of the same model, or the same
+    structure fit separately to many datasets.
+
+    The model is built once, from nodes constructed with replicated=True
+    (see ConditionalDistribution): the leading axis of every node's
+    shape indexes the replica, so e.g.
+
+      mu = Gaussian(mean=0., std=10., shape=(R, 1), replicated=True)
+      X = Gaussian(mean=mu, std=1., shape=(R, n), replicated=True)
+      X.observe(data)   # data[r] is replica r's dataset
+
+    and every parameter of the default Q distributions gets the same
+    leading axis. Currently the elementary Gaussian and Laplace
+    distributions support replication.
+
+    Each replica has its own ELBO (see Model.replica_elbos), ELBO trace
+    and copy of the stopping rule. A training step is one session.run
+    over all replicas, but only the rows of the still-active replicas
+    get an Adam update (LazyAdamOptimizer with a sparse gradient), so
+    a stopped replica keeps its parameters and Adam state.
+
+    Replicas can be labeled with groups (e.g. one group per dataset,
+    holding its restarts), and best_replicas() picks the replica with
+    the highest final ELBO in each group.
+    """
+
+    def __init__(self, nodes, groups=None):
+        if isinstance(nodes, ConditionalDistribution):
+            nodes = [nodes,]
+        self.model = Model(*nodes)
+        if self.model.n_replicas is None:
+            raise Exception("ReplicatedModel requires nodes constructed with replicated=True")
+
+        self.n_replicas = self.model.n_replicas
+        self.groups = groups if groups is not None else [0,] * self.n_replicas
+        assert(len(self.groups) == self.n_replicas)
+
+        self._train_ops = None
+        self.traces = [[] for r in range(self.n_replicas)]
+
+    def _get_train_ops(self):
+        if self._train_ops is None:
+            with self.model.graph.as_default():
+                elbos = self.model.replica_elbos()
+                variables = self.model.trainable_variables
+                if variables is None:
+                    variables = tf.trainable_variables()
+                for v in variables:
+                    shape = v.get_shape().as_list()
+                    if len(shape) == 0 or shape[0] != self.n_replicas:
+                        raise Exception("variable %s of shape %s isn't replicated, so would be shared between replicas" % (v.name, shape))
+
+                with tf.name_scope("replicated_train"):
+                    active = tf.placeholder(dtype=tf.int32, shape=(None,), name="active_replicas")
+                    rate = tf.placeholder(dtype=tf.float32, shape=(), name="adam_rate")
+                    grads = tf.gradients(-tf.reduce_sum(elbos), variables)
+                    sparse_grads = [(tf.IndexedSlices(tf.gather(tf.convert_to_tensor(g), active), active, tf.shape(v)), v)
+                                    for (g, v) in zip(grads, variables) if g is not None]
+                    optimizer = LazyAdamOptimizer(rate)
+                    train_step = optimizer.apply_gradients(sparse_grads)
+                self.model._model_variables.update(optimizer.variables())
+            self._train_ops = (train_step, elbos, active, rate)
+        return self._train_ops
+
+    def get_session(self):
+        return self.model.get_session(do_init=False)
+
+    def train(self, adam_rate=0.1, stopping_rule=None, steps=None, avg_decay=None, print_s=1):
+        """
+        Train all replicas until each one's own copy of the stopping rule
+        fires. Returns a list of the final ELBO values.
+        """
+        if stopping_rule is None:
+            if steps is not None:
+                stopping_rule = StepCountStopper(step_count=steps)
+            elif avg_decay is not None:
+                stopping_rule = MovingAverageStopper(decay=avg_decay)
+            else:
+                stopping_rule = MovingAverageStopper()
+        stopping_rules = [copy.deepcopy(stopping_rule) for r in range(self.n_replicas)]
+
+        train_step, elbos, active_idxs, rate = self._get_train_ops()
+        session = self.get_session()
+        self.model.initialize_new_variables()
+        self.model._posterior_cache = None
+
+        active = []
+        for r, rule in enumerate(stopping_rules):
+            rule.reset()
+            if not rule.observe(None):
+                active.append(r)
+
+        i = 0
+        t = -np.inf
+        while len(active) > 0:
+            fd = {active_idxs: active, rate: adam_rate}
+            model_fd = self.model.feed_dict()
+            if model_fd is not None:
+                fd.update(model_fd)
+
+            _, elbo_vals = session.run((train_step, elbos), feed_dict=fd)
+
+            still_active = []
+            for r in active:
+                self.traces[r].append(elbo_vals[r])
+                if not stopping_rules[r].observe(elbo_vals[r]):
+                    still_active.append(r)
+            i += 1
+
+            if print_s is not None and (time.time() - t) > print_s:
+                print("step %d: %d of %d replicas active, best elbo %.2f" % (i, len(still_active), self.n_replicas, np.max(elbo_vals[active])))
+                t = time.time()
+            active = still_active
+
+        return self.final_elbos()
+
+    def final_elbos(self, window=10):
+        """
+        Mean ELBO over each replica's last `window` training steps.
+        """
+        return [np.mean(trace[-window:]) if len(trace) > 0 else -np.inf for trace in self.traces]
+
+    def best_replicas(self, window=10):
+        """
+        Return a dict mapping each group to the index of its replica with
+        the highest final ELBO.
+        """
+        scores = self.final_elbos(window=window)
+        best = {}
+        for r, (group, score) in enumerate(zip(self.groups, scores)):
+            if group not in best or score > scores[best[group]]:
+                best[group] = r
+        return best
+
+    def posterior(self, r):
+        """
+        Variational parameters of replica r, in the format of
+        Model.posterior.
+        """
+        posterior = {}
+        for (node_name, params) in self.model.posterior().items():
+            posterior[node_name] = {name: val[r] if np.ndim(val) > 0 else val for (name, val) in params.items()}
+        return posterior
+
+    def close(self):
+        self.model.close()
@@ -5,7 +5,7 @@ import tensorflow as tf
 
 # import elbow.util as util
 from elbow.util import shapes_equal, shape_is_scalar, extract_shape
-from elbow.conditional_dist import ConditionalDistribution
+from elbow.conditional_dist import ConditionalDistribution, _remember, _replace
 
 
 class DeterministicTransform(ConditionalDistribution):
@@ -48,27 +48,40 @@ class UnaryTransform(DeterministicTransform):
         self.transform=transform
         assert(isinstance(A, ConditionalDistribution))
         super(UnaryTransform, self).__init__(A=A, **kwargs)
+        self.__dict__.update(self._structural_parameters())
 
-        if transform.is_structural():
-            # pass through transformed elementwise params
-            transformed = {}
-            for inp_name, shape in A.input_shapes.items():
-                inp = getattr(A, inp_name)
-                if shapes_equal(shape, A.shape):
-                # if util.shapes_equal(shape, A.shape):
-                    transformed[inp_name] = transform.transform(inp)
-                elif shape_is_scalar(shape):
-                # elif util.shape_is_scalar(shape):
-                    transformed[inp_name] = inp
-
-            try:
-                derived = A.derived_parameters(**transformed)
-            except Exception as e:
-                print("could not derive additional parameters for structural transform %s of %s: %s" % (transform, A, e))
-                derived = {}
-
-            self.__dict__.update(transformed)
-            self.__dict__.update(derived)
+    def _structural_parameters(self):
+        if not self.transform.is_structural():
+            return {}
+        
+        # pass through transformed elementwise params
+        A = self.inputs_random["A"]
+        transformed = {}
+        for inp_name, shape in A.input_shapes.items():
+            inp = getattr(A, inp_name)
+            if shapes_equal(shape, A.shape):
+            # if util.shapes_equal(shape, A.shape):
+                transformed[inp_name] = self.transform.transform(inp)
+            elif shape_is_scalar(shape):
+            # elif util.shape_is_scalar(shape):
+                transformed[inp_name] = inp
+
+        try:
+            derived = A.derived_parameters(**transformed)
+        except Exception as e:
+            print("could not derive additional parameters for structural transform %s of %s: %s" % (self.transform, A, e))
+            derived = {}
+
+        transformed.update(derived)
+        return transformed
+
+    def _redraw(self, saved):
+        super(UnaryTransform, self)._redraw(saved)
+        _replace(self, self._structural_parameters(), saved)
+
+    def _rebind_parameters(self, rebuild, saved):
+        super(UnaryTransform, self)._rebind_parameters(rebuild, saved)
+        _replace(self, self._structural_parameters(), saved)
             
     def inputs(self):
         d = {"A": None}
@@ -129,17 +142,42 @@ class TransformedDistribution(ConditionalDistribution):
         super(TransformedDistribution, self).__init__(**kwargs)
 
 
-        for inp_name, shape in self.dist.input_shapes.items():
-            if transform.is_structural() and shape==self.dist.shape:
-                # for structural transforms, pass through
-                # transformed elementwise params
-                inp = getattr(self.dist, inp_name)
-                setattr(self, inp_name, transform.transform(inp))
+        structural = self._structural_parameters()
+        for inp_name in self.dist.input_shapes.keys():
+            if inp_name in structural:
+                setattr(self, inp_name, structural[inp_name])
             else:
                 # don't pass through params in any other cases
                 # (so we need to delete the values set by the constructor)
                 delattr(self, inp_name)
 
+    def _structural_parameters(self):
+        # for structural transforms, pass through
+        # transformed elementwise params
+        structural = {}
+        for inp_name, shape in self.dist.input_shapes.items():
+            if self.transform.is_structural() and shape==self.dist.shape:
+                inp = getattr(self.dist, inp_name)
+                structural[inp_name] = self.transform.transform(inp)
+        return structural
+
+    def _redraw(self, saved):
+        # the wrapped distribution isn't a node of the model, so we 
+        # redraw it here, then transform its new sample
+        self.dist._redraw(saved)
+        _remember(self, ["_sampled", "_sampled_entropy", "_sampled_log_jacobian"], saved)
+        sample, entropy = self._sample_and_entropy()
+        attrs = self._structural_parameters()
+        attrs["_sampled"] = sample
+        attrs["_sampled_entropy"] = entropy
+        _replace(self, attrs, saved)
+
+    def _rebind_parameters(self, rebuild, saved):
+        # our nonrandom inputs are those of the wrapped distribution
+        self.dist._rebind_parameters(rebuild, saved)
+        attrs = self._structural_parameters()
+        attrs["inputs_nonrandom"] = self.dist.inputs_nonrandom
+        _replace(self, attrs, saved)
         
     def _setup_inputs(self, **kwargs):
         self.inputs_random = self.dist.inputs_random
@@ -599,7 +637,7 @@ class Simplex(Transform):
 
     @classmethod
     def transform(cls, x, **kwargs):
-        xmax = tf.expand_dims(tf.reduce_max(x, axis=1), axis=1)
+        xmax = tf.expand_dims(tf.reduce_max(x, axis=-1), axis=-1)
         return Simplex_Raw.transform(x-xmax, **kwargs)
 
 class SimplexCol(Transform):
@@ -0,0 +1,63 @@
+import numpy as np
+import tensorflow as tf
+
+import sys
+import time
+
+from elbow import Model
+from elbow.joint_model import StepCountStopper
+from elbow.parameterization import unconstrained
+from elbow.models.factorizations import NoisySparseGaussianMatrixProduct
+
+"""
+Time per training step of a large sparse matrix factorization fit by
+minibatch SVI, with the stock Adam optimizer and with Model(lazy_adam=True).
+The factor matrices are point estimates read only through tf.gather,
+so each minibatch touches a few thousand of their rows; stock Adam
+still updates the moments of every row on every step, while lazy Adam
+only updates the touched rows.
+
+Usage: python benchmark_lazy_adam.py [n_rows n_cols nnz]
+(default 10M x 1M with 10M observed entries; needs a few GB of RAM).
+"""
+
+def synthetic_ratings(N, M, nnz, k, seed=0):
+    rs = np.random.RandomState(seed)
+    A = np.float32(rs.randn(N, k))
+    B = np.float32(rs.randn(M, k))
+    rows = np.int32(rs.randint(N, size=nnz))
+    cols = np.int32(rs.randint(M, size=nnz))
+    values = np.float32(np.sum(A[rows] * B[cols], axis=1) + 0.1 * rs.randn(nnz))
+    return rows, cols, values
+
+def build_model(N, M, k, batch_size, lazy_adam):
+    with tf.Graph().as_default():
+        tf.set_random_seed(0)
+        np.random.seed(0)
+        A = unconstrained(shape=(N, k), name="A")
+        B = unconstrained(shape=(M, k), name="B")
+        R = NoisySparseGaussianMatrixProduct(A=A, B=B, std=0.1, batch_size=batch_size, name="R")
+        return Model(R, lazy_adam=lazy_adam), R
+
+def main(N=10000000, M=1000000, nnz=10000000):
+    N, M, nnz = int(N), int(M), int(nnz)
+    k = 4
+    batch_size = 1000
+    rows, cols, values = synthetic_ratings(N, M, nnz, k)
+
+    for lazy_adam in (False, True):
+        jm, R = build_model(N, M, k, batch_size, lazy_adam)
+        jm.register_feed(R.observe_minibatches(rows, cols, values))
+
+        # the first steps include graph setup and variable initialization
+        jm.train(stopping_rule=StepCountStopper(step_count=5), adam_rate=0.01, print_s=None)
+
+        n_steps = 200
+        t0 = time.time()
+        elbo, _, _ = jm.train(stopping_rule=StepCountStopper(step_count=n_steps), adam_rate=0.01, print_s=None)
+        elapsed = time.time() - t0
+        print("lazy_adam=%s: %.2f ms/step, minibatch elbo %.1f" % (lazy_adam, 1000*elapsed/n_steps, elbo))
+        jm.close()
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
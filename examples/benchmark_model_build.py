@@ -0,0 +1,50 @@
+import numpy as np
+import tensorflow as tf
+
+import time
+
+from elbow import Gaussian, Model
+from elbow.transforms import UnaryTransform, Exp
+
+"""
+Time Model construction on deep hierarchical models whose nodes share
+ancestors. Each layer has two Gaussians, each taking its mean from
+one node of the previous layer and its (log) std from the other, so the 
+number of ancestor *paths* doubles with every layer even though the 
+number of nodes grows only linearly. 
+"""
+
+def naive_ancestors(node):
+    # the original recursive implementation, for comparison
+    return set([node,] + [ancestor_node for inp in node.inputs_random.values() for ancestor_node in naive_ancestors(inp)])
+
+def build_lattice(depth):
+    a = Gaussian(mean=0.0, std=1.0, shape=(1,), name="a0")
+    b = Gaussian(mean=0.0, std=1.0, shape=(1,), name="b0")
+    for i in range(1, depth):
+        std_a = UnaryTransform(a, Exp, name="exp_a%d" % i)
+        std_b = UnaryTransform(b, Exp, name="exp_b%d" % i)
+        a, b = (Gaussian(mean=b, std=std_a, shape=(1,), name="a%d" % i),
+                Gaussian(mean=a, std=std_b, shape=(1,), name="b%d" % i))
+    return a, b
+
+def main():
+    for depth in (10, 15, 20, 250, 1000):
+        tf.reset_default_graph()
+        a, b = build_lattice(depth)
+
+        t0 = time.time()
+        jm = Model(a, b)
+        t_model = time.time() - t0
+        
+        if depth <= 20:
+            t0 = time.time()
+            naive_ancestors(a).union(naive_ancestors(b))
+            t_naive = "%.3fs" % (time.time() - t0)
+        else:
+            t_naive = "(skipped)"
+
+        print("depth %d: %d nodes, Model() %.3fs, naive ancestors %s" % (depth, len(jm.component_nodes), t_model, t_naive))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+import numpy as np
+import tensorflow as tf
+
+import time
+
+from elbow import Gaussian, Model
+from elbow.joint_model import MovingAverageStopper
+from elbow.transforms import UnaryTransform, Exp
+from elbow.models.factorizations import NoisyGaussianMatrixProduct
+
+"""
+Time-to-convergence of a low-rank matrix factorization trained with 
+the multi-particle ELBO estimator, for several numbers of particles S. 
+The noise std has a lognormal prior, so its expectation is estimated
+from samples (the factors' terms are analytic, and don't depend on S). 
+More particles make each step more expensive but reduce gradient noise, 
+so fewer steps may be needed before the moving-average stopping rule 
+fires. We report wall-clock time, steps taken, and a Monte Carlo 
+estimate of the final ELBO. 
+"""
+
+def build_model(X, n_particles, k=3, seed=0):
+    N, M = X.shape
+    np.random.seed(seed)
+    with tf.Graph().as_default():
+        tf.set_random_seed(seed)
+        A = Gaussian(mean=0.0, std=1.0, shape=(N, k), name="A")
+        B = Gaussian(mean=0.0, std=1.0, shape=(M, k), name="B")
+        logstd = Gaussian(mean=-2.0, std=1.0, shape=(1, 1), name="logstd")
+        std = UnaryTransform(logstd, Exp, name="std")
+        C = NoisyGaussianMatrixProduct(A=A, B=B, std=std, name="C")
+        C.observe(X)
+        return Model(C, n_particles=n_particles)
+
+def main():
+    N, M, k = 200, 100, 3
+    np.random.seed(0)
+    X = np.float32(np.dot(np.random.randn(N, k), np.random.randn(M, k).T) + 0.1 * np.random.randn(N, M))
+
+    for n_particles in (1, 2, 4, 8, 16):
+        jm = build_model(X, n_particles)
+        stopper = MovingAverageStopper(decay=0.99, eps=0.5, min_steps=100)
+
+        t0 = time.time()
+        jm.train(stopping_rule=stopper, adam_rate=0.05, print_s=None)
+        elapsed = time.time() - t0
+
+        elbo, stderr, _ = jm.monte_carlo_elbo(200, vectorized=True, chunk_size=50, return_all=True)
+        print("S=%d: %d steps in %.1fs (%.1f ms/step), final elbo %.1f +- %.1f" % (n_particles, stopper.steps, elapsed, 1000*elapsed/stopper.steps, elbo, stderr))
+        jm.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+import numpy as np
+import tensorflow as tf
+
+import time
+
+from elbow.joint_model import BatchGenerator, StepCountStopper
+
+from matrix_factorization import sparse_model, sample_sparsity
+from vae_minibatch import build_vae
+
+"""
+Compare training throughput (steps/sec) of the fused training step,
+which fetches the ELBO from the same session.run as the optimizer
+update, against the unfused step, which recomputes the ELBO in a 
+second run. Then, for the matrix factorization model (which has no
+feed), compare single steps against blocks of steps_per_check steps,
+each run as one in-graph loop. 
+"""
+
+def matrix_factorization_model(n=2000, m=1000, sparsity=0.05):
+    nzr, nzc = sample_sparsity(n, m, sparsity)
+    jm = sparse_model(nzr, nzc, n=n, m=m)
+    sampled = jm.sample()
+    jm["C"].observe(sampled["C"])
+    return jm
+
+def vae_model(N=60000, d_x=784, batchsize=100):
+    # random binary images stand in for MNIST, so the benchmark
+    # doesn't need to download anything.
+    Xtrain = np.float32(np.random.rand(N, d_x) > 0.5)
+    jm, x_batch = build_vae(d_x=d_x, N=batchsize, total_N=N)
+
+    batches = BatchGenerator(Xtrain, batch_size=batchsize)
+    jm.register_feed(lambda : {x_batch: batches.next_batch()})
+    return jm
+
+def steps_per_sec(build_model, steps, **train_kwargs):
+    tf.reset_default_graph()
+    np.random.seed(0)
+    jm = build_model()
+
+    # exclude graph construction and initialization from the timing
+    jm.train(stopping_rule=StepCountStopper(step_count=1), print_s=None, **train_kwargs)
+    
+    t0 = time.time()
+    jm.train(stopping_rule=StepCountStopper(step_count=steps), print_s=None, **train_kwargs)
+    elapsed = time.time() - t0
+    return steps / elapsed
+
+def main():
+    steps = 500
+    for name, build_model in (("matrix_factorization", matrix_factorization_model),
+                              ("vae_minibatch", vae_model)):
+        unfused = steps_per_sec(build_model, steps, fused=False)
+        fused = steps_per_sec(build_model, steps, fused=True)
+        print("%s: unfused %.1f steps/sec, fused %.1f steps/sec (%.2fx)" % (name, unfused, fused, fused/unfused))
+
+    for name, build_model in (("matrix_factorization (small)", lambda : matrix_factorization_model(n=200, m=100)),
+                              ("matrix_factorization", matrix_factorization_model)):
+        single = steps_per_sec(build_model, steps)
+        for steps_per_check in (10, 100):
+            blocked = steps_per_sec(build_model, steps, steps_per_check=steps_per_check)
+            print("%s: single steps %.1f steps/sec, blocks of %d %.1f steps/sec (%.2fx)" % (name, single, steps_per_check, blocked, blocked/single))
+
+if __name__ == "__main__":
+    main()
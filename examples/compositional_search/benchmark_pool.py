@@ -0,0 +1,68 @@
+import numpy as np
+import tensorflow as tf
+
+import multiprocessing
+import time
+
+from elbow.joint_model import StepCountStopper
+
+from models import build_model
+from search import ExperimentSettings, expand_beam, make_pool, score_and_sort_beam
+
+"""
+Wall-clock time to score one round of structure-search candidates
+serially and on process pools of increasing size. The beam is the
+expansion of a few structures, each candidate trains for a fixed
+number of steps, and nothing is cached, so every configuration does
+the same work. We report the time taken and the speedup over serial
+scoring; the scores should be the same in every configuration.
+"""
+
+def base_settings():
+    settings = ExperimentSettings()
+    settings.max_rank = 2
+    settings.gaussian_auto_ard = False
+    settings.constant_gaussian_std = 1.0
+    settings.constant_noise_std = 0.1
+    settings.stopping_rule = StepCountStopper(step_count=500)
+    settings.warm_start = False
+    settings.template_cache_size = 0
+    return settings
+
+def candidate_beam(settings):
+    beam = [('g', 0.0, None), (('lowrank', 'g', 'g'), 0.0, None)]
+    return expand_beam(beam, settings)
+
+def main():
+    N, D = 200, 40
+    np.random.seed(0)
+    with tf.Graph().as_default():
+        tf.set_random_seed(0)
+        X = build_model(('lowrank', 'g', 'g'), (N, D), base_settings(), local=False).sample()
+
+    n_cpus = multiprocessing.cpu_count()
+    worker_counts = [None,] + [n for n in (2, 4, 8) if n <= n_cpus]
+    if len(worker_counts) == 1:
+        print("only %d cpu, timing serial scoring alone" % n_cpus)
+    serial_s = None
+    for n_workers in worker_counts:
+        settings = base_settings()
+        settings.n_workers = n_workers
+        beam = candidate_beam(settings)
+
+        # start the workers before timing, so their spawn cost isn't counted
+        pool = make_pool(X, settings) if n_workers is not None else None
+        t0 = time.time()
+        scored = score_and_sort_beam(beam, X, settings, pool=pool)
+        elapsed = time.time() - t0
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+        if serial_s is None:
+            serial_s = elapsed
+        print("%s workers: scored %d candidates in %.1fs (%.2fx), best %s" % (n_workers or "no", len(beam), elapsed,
+                                                                        serial_s / elapsed, scored[0][0]))
+
+if __name__ == "__main__":
+    main()
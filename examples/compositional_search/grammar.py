@@ -3,6 +3,8 @@ Borrowed and modified from Roger Grosse,
 https://github.com/rgrosse/compositional_structure_search
 """
 
+from functools import reduce
+
 START = 'g'
 
 PRODUCTION_RULES = {'low-rank':          [('g',     ('lowrank', 'g', 'g'))],
@@ -42,10 +44,29 @@ def list_successors_helper(structure, rule_names):
     return successors
 
 def list_successors(structure, rules=None):
+    return distinct_successors(structure, rules)[0]
+
+def distinct_successors(structure, rules=None):
+    """Returns the valid successors of a structure in canonical form,
+    with duplicates removed, along with the number of expansions that
+    were pruned as duplicates."""
     if rules is None:
         rules = PRODUCTION_RULES.keys()
-    successors = list_successors_helper(structure, rules)
-    return filter(is_valid, successors)
+    successors = [canonical_form(s) for s in list_successors_helper(structure, rules)]
+    successors = [s for s in successors if is_valid(s)]
+    distinct = unique_structures(successors)
+    return distinct, len(successors) - len(distinct)
+
+def unique_structures(structures):
+    # keep the first copy of each structure, in order
+    seen = set()
+    unique = []
+    for s in structures:
+        key = canonical_form(s)
+        if key not in seen:
+            seen.add(key)
+            unique.append(s)
+    return unique
 
 def collapse_sums(structure):
     if type(structure) == str:
@@ -62,6 +83,33 @@ def collapse_sums(structure):
     else:
         return tuple([collapse_sums(s) for s in structure])
 
+def canonical_form(structure):
+    """Rewrites a structure into a normal form, so that different 
+    derivations of the same model compare (and hash) equal: nested 
+    sums are flattened and their terms sorted, double transposes 
+    cancel, and a transposed low-rank product swaps its factors, since
+    (AB')' = BA'."""
+    if type(structure) == str:
+        return structure
+    structure = (structure[0],) + tuple([canonical_form(s) for s in structure[1:]])
+
+    if structure[0] == '+':
+        terms = []
+        for s in structure[1:]:
+            if type(s) == tuple and s[0] == '+':
+                terms += s[1:]
+            else:
+                terms.append(s)
+        return ('+',) + tuple(sorted(terms, key=repr))
+    
+    if structure[0] == 'transpose' and type(structure[1]) == tuple:
+        inner = structure[1]
+        if inner[0] == 'transpose':
+            return inner[1]
+        if inner[0] == 'lowrank':
+            return ('lowrank', inner[2], inner[1])
+    return structure
+
 def list_collapsed_successors(structure, rule_names):
     return [collapse_sums(s) for s in list_successors_helper(structure, rule_names)
             if is_valid(collapse_sums(s))]
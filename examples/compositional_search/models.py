@@ -153,13 +153,13 @@ def build_model(structure, shape, settings, tree_path="g", local=True):
         g = build_model(structure[2], (K, D), settings, tree_path + "f", local=False)
         model = build_features(b, g, settings, tree_path, local=local)
     elif structure[0] == 'chain':
-        g = build_model(structure[1], (N, D), settings, tree_path + "C")
+        g = build_model(structure[1], (N, D), settings, tree_path + "C", local=local)
         model = build_chain(g, settings, tree_path)
     elif structure[0] == "sparse":
         g = build_model(structure[1], (N, D), settings, tree_path + "s", local=local)
         model = build_sparsity(g, settings, tree_path, local=local)
     elif structure[0] == "transpose":
-        g = build_model(structure[1], (D, N), settings, tree_path + "t")
+        g = build_model(structure[1], (D, N), settings, tree_path + "t", local=False)
         model = build_transpose(g, tree_path)
     else:
         raise Exception("invalid structure %s" % repr(structure))
@@ -175,7 +175,7 @@ def sanity_check_model_recovery(structures, settings):
     samples = [build_model(structure, (N, D), settings).sample() for structure in structures]
         
     for i, sample in enumerate(samples):
-        print("using X sampled from", structures[i)
+        print("using X sampled from", structures[i])
 
         batch_N = 32
         
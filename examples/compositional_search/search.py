@@ -1,12 +1,17 @@
 import numpy as np
 import tensorflow as tf
 import copy
+import multiprocessing
+import sqlite3
+import io
+import hashlib
+import collections
 
-import elbo.util as util
+import elbow.util as util
 
-from elbo.joint_model import Model, MovingAverageStopper
+from elbow.joint_model import Model, MovingAverageStopper, StepCountStopper
 
-from grammar import list_successors
+from grammar import list_successors, distinct_successors, canonical_form
 from models import build_model
 
 
@@ -32,6 +37,125 @@ class ExperimentSettings(object):
         self.beamsize = 2
         self.p_stop_structure = 0.3
         self.n_elbo_samples = 50
+        self.seed = 0
+
+        # number of worker processes for scoring candidates in parallel
+        # (None to score in this process), and the number of TF threads
+        # each candidate may use.
+        self.n_workers = None
+        self.tf_threads = 1
+
+        # path of an sqlite file in which to memoize candidate scores
+        # across runs (None to memoize only within this search).
+        self.score_cache = None
+
+        # initialize each successor structure from its parent's trained
+        # variational parameters, for the subtrees they share.
+        self.warm_start = True
+
+        # successive halving: if halving_steps is given, e.g. (100, 300),
+        # new candidates first train for that many steps at each rung
+        # in turn, scored with a cheap halving_elbo_samples-sample ELBO,
+        # and only the best halving_keep fraction survives each rung.
+        # Survivors then train to convergence, continuing from the 
+        # parameters they reached while racing. halving_rows
+        # optionally gives the number of leading rows of X to fit at 
+        # each rung.
+        self.halving_steps = None
+        self.halving_keep = 0.5
+        self.halving_rows = None
+        self.halving_elbo_samples = 5
+
+        # number of built candidate graphs each process keeps for reuse
+        # by later candidates with the same structure and data shape
+        # (0 to build every candidate from scratch).
+        self.template_cache_size = 16
+
+# settings that affect how fast candidates are scored, but not the scores.
+_UNSCORED_SETTINGS = ("n_workers", "tf_threads", "score_cache", "template_cache_size")
+
+def settings_key(settings, exclude=_UNSCORED_SETTINGS):
+    """A string determined by the values of all settings not in 
+    exclude."""
+    items = []
+    for name in sorted(vars(settings)):
+        if name in exclude:
+            continue
+        value = getattr(settings, name)
+        if hasattr(value, "reset"):
+            # stopping rules carry per-run state; use a fresh copy
+            value = copy.deepcopy(value)
+            value.reset()
+        if hasattr(value, "__dict__"):
+            value = (type(value).__name__, sorted(vars(value).items()))
+        items.append((name, value))
+    return repr(items)
+
+def settings_fingerprint(X, settings):
+    """Hash of the data and of every setting that can change a
+    candidate's score, so cached scores are only reused for the same
+    experiment."""
+    h = hashlib.sha1()
+    X = np.ascontiguousarray(X)
+    h.update(repr((X.dtype.str, X.shape)).encode("utf-8"))
+    h.update(X.tobytes())
+    h.update(settings_key(settings).encode("utf-8"))
+    return h.hexdigest()
+
+class ScoreCache(object):
+    """
+    Persistent memo of model scores (not including the structure
+    prior), keyed by the canonical form of a structure and a
+    fingerprint of the data and settings, along with the trained
+    variational parameters (if any), so that the successors of a 
+    cached structure can still be warm-started from it. Lives in the
+    parent process; workers never touch it.
+    """
+    
+    def __init__(self, path, X, settings):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS scores "
+                          "(experiment TEXT, structure TEXT, score REAL, params BLOB, "
+                          "PRIMARY KEY (experiment, structure))")
+        # cache files written before parameters were stored lack the
+        # column; their entries just don't warm-start anything
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(scores)")]
+        if "params" not in columns:
+            self.conn.execute("ALTER TABLE scores ADD COLUMN params BLOB")
+        self.conn.commit()
+        self.experiment = settings_fingerprint(X, settings)
+
+    def _key(self, structure):
+        return repr(canonical_form(structure))
+        
+    def get(self, structure):
+        """Return the cached (score, params) of a structure, with params
+        None if they weren't stored, or None if it isn't cached."""
+        row = self.conn.execute("SELECT score, params FROM scores WHERE experiment=? AND structure=?",
+                                (self.experiment, self._key(structure))).fetchone()
+        if row is None:
+            return None
+        score, blob = row
+        params = None
+        if blob is not None:
+            with np.load(io.BytesIO(blob)) as f:
+                params = {k: f[k] for k in f.files}
+        return score, params
+
+    def put(self, structure, score, params=None):
+        blob = None
+        if params is not None:
+            buf = io.BytesIO()
+            np.savez(buf, **params)
+            blob = sqlite3.Binary(buf.getvalue())
+        # commit each score as it arrives, so an interrupted search
+        # keeps everything it finished.
+        self.conn.execute("INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?)",
+                          (self.experiment, self._key(structure), float(score), blob))
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
         
 def beamsearch_helper(beam, beamsize=2):
     scores = [score(model) for model in beam]
@@ -46,70 +170,363 @@ def beamsearch_helper(beam, beamsize=2):
     return newbeam
 
 
-def score_model(structure, X, settings):
-    N, D = X.shape
-    m = build_model(structure, (N, D), settings)
-    m.observe(X)
+def score_model(structure, X, settings, init=None, budget=None):
+    """
+    Train a model of the given structure on X and return its Monte 
+    Carlo ELBO, along with its trained variational parameters. If 
+    init holds the parameters of a previously trained model (e.g. the
+    structure this one was expanded from), subtrees the two models 
+    share start from those values. 
 
-    jm = Model(m)
+    If budget=(n_steps, n_rows) is given, we instead train for a fixed
+    number of steps on the first n_rows rows of X (all of X if None), 
+    and return a cheap ELBO estimate scaled up to the full data. 
+    """
+    stopping_rule = settings.stopping_rule
+    n_samples = settings.n_elbo_samples
+    scale = 1.0
+    if budget is not None:
+        n_steps, n_rows = budget
+        stopping_rule = StepCountStopper(step_count=n_steps)
+        n_samples = settings.halving_elbo_samples
+        if n_rows is not None and n_rows < X.shape[0]:
+            scale = X.shape[0] / float(n_rows)
+            X = X[:n_rows]
+        
+    jm, observed = candidate_model(structure, X.shape, settings)
+    if observed_structure(structure)[2]:
+        X = X.T
+    jm.register_feed(lambda : {observed: X})
+    if init is not None:
+        initialize_from(init, jm)
 
-    jm.train(silent=True,
-             stopping_rule=settings.stopping_rule,
+    jm.train(print_s=None,
+             stopping_rule=stopping_rule,
              adam_rate=settings.adam_rate)
-    score = jm.monte_carlo_elbo(n_samples=settings.n_elbo_samples)
+    score = jm.monte_carlo_elbo(n_samples=n_samples) * scale
+    params = jm.variational_values()
+    release_candidate_model(jm, settings)
+    
+    return score, params
+
+def observed_structure(structure, tree_path="g"):
+    """
+    A transposed model is a deterministic transform, which can't be
+    observed directly, so we model the transpose of X instead. Returns
+    the structure with its outer transposes stripped, the tree path
+    of its root (so its nodes are named as in the full structure), and
+    whether the data are to be transposed. 
+    """
+    transposed = False
+    while isinstance(structure, tuple) and structure[0] == "transpose":
+        structure, tree_path = structure[1], tree_path + "t"
+        transposed = not transposed
+    return structure, tree_path, transposed
+
+# built candidate models, most recently used last, keyed by structure,
+# data shape and settings. 
+_templates = collections.OrderedDict()
+
+def candidate_model(structure, shape, settings):
+    """
+    Return a Model of the given structure with a placeholder for the 
+    observed data, reusing a previously built graph (ops, ELBO and 
+    optimizer) for the same structure and shape if we have one, with
+    its variables reset. Otherwise the model is built in a fresh graph,
+    so its ops and variables are freed once it's discarded.
+    """
+    key = (canonical_form(structure), tuple(shape),
+           settings_key(settings, exclude=("n_workers", "score_cache", "template_cache_size")))
+    if key in _templates:
+        jm, observed = _templates.pop(key)
+        jm.reset_variables()
+        _templates[key] = (jm, observed)
+        return jm, observed
+    
+    with tf.Graph().as_default():
+        # seed each candidate the same way, so a structure's score
+        # doesn't depend on which process or round scored it, or 
+        # whether its graph was reused.
+        np.random.seed(settings.seed)
+        tf.set_random_seed(settings.seed)
+        inner, tree_path, transposed = observed_structure(structure)
+        if transposed:
+            shape = shape[::-1]
+        m = build_model(inner, shape, settings, tree_path=tree_path, local=False)
+        observed = m.observe_placeholder()
+
+        session_config = None
+        if settings.tf_threads is not None:
+            session_config = tf.ConfigProto(intra_op_parallelism_threads=settings.tf_threads,
+                                            inter_op_parallelism_threads=settings.tf_threads)
+        jm = Model(m, session_config=session_config)
+
+    if settings.template_cache_size > 0:
+        _templates[key] = (jm, observed)
+        while len(_templates) > settings.template_cache_size:
+            _, (old_jm, _) = _templates.popitem(last=False)
+            old_jm.close()
+    return jm, observed
+
+def release_candidate_model(jm, settings):
+    # free the session's memory, keeping the graph if it's cached
+    if settings.template_cache_size > 0:
+        jm.reset_variables()
+    else:
+        jm.close()
+
+# numerical failures of a candidate's training (a non-finite objective,
+# a failed Cholesky or numerics check), which score it -inf rather 
+# than abort the search. Anything else is a bug and is raised. 
+_SCORING_FAILURES = (FloatingPointError, np.linalg.LinAlgError, tf.errors.InvalidArgumentError)
 
-    return score
+def score_candidate(structure, X, settings, init=None, budget=None):
+    try:
+        score, params = score_model(structure, X, settings, init=init, budget=budget)
+    except _SCORING_FAILURES as e:
+        print("could not score structure", structure, e)
+        return -np.inf, None
 
-def initialize_from(old_model, new_model):
-    for name, new_node in new_model.input_nodes.items():
-        if name in old_model.input_nodes:
-            old_node = old_model.input_nodes[name]
-            initialize_from(old_node, new_node)
+    # the stopping rules end training on a non-finite objective
+    # rather than raising, so the score itself may be nan or inf
+    if not np.isfinite(score):
+        print("could not score structure", structure, "non-finite ELBO", score)
+        return -np.inf, None
+    return score, params
     
-    old_qdist = old_model.q_distribution()
-    new_qdist = old_model.q_distribution()
-    if isinstance(old_qdist, GaussianQistribution):
-        # TODO figure out the right, elegant way to do this
-        # see doc for discussion
-        # new_qdist._intialize(old_qdist.mean, old_qdist.logodds)
-        pass
-def score_and_sort_beam(beam, X, settings):
+def initialize_from(old_params, new_model):
+    """
+    Warm-start new_model from the trained variational parameters of 
+    another structure. Nodes are named by their path in the structure 
+    tree, so a successor's untouched subtrees (and the noise and ARD 
+    parameters hanging off them) have the same names and shapes as in 
+    its parent, and take the parent's values; the subtree that a 
+    production rewrote keeps its fresh initialization. 
+    """
+    return new_model.restore(old_params, verbose=False)
+
+# data and settings shared by all tasks in a worker process, set
+# once by the pool initializer rather than pickled with every task.
+_worker_state = {}
+
+def _init_worker(X, settings):
+    # (each candidate's TF threads are set through its session_config,
+    # see candidate_model)
+    _worker_state["X"] = X
+    _worker_state["settings"] = settings
+
+def _score_task(task):
+    i, structure, init, budget = task
+    return i, score_candidate(structure, _worker_state["X"], _worker_state["settings"],
+                              init=init, budget=budget)
+
+def make_pool(X, settings):
+    # spawn rather than fork, so workers don't inherit any TF runtime
+    # state from the parent process.
+    ctx = multiprocessing.get_context("spawn")
+    return ctx.Pool(settings.n_workers, initializer=_init_worker, initargs=(X, settings))
+
+def run_tasks(tasks, X, settings, pool=None):
+    """
+    Score (i, structure, init, budget) tasks, on the pool if given, 
+    yielding (i, (score, params)) in whatever order they finish.
+    """
+    if pool is None:
+        for (i, structure, init, budget) in tasks:
+            yield i, score_candidate(structure, X, settings, init=init, budget=budget)
+    else:
+        # candidates are independent, so score them on the pool and 
+        # collect results in whatever order they finish. 
+        for result in pool.imap_unordered(_score_task, tasks):
+            yield result
+
+def successive_halving(tasks, X, settings, pool=None):
+    """
+    Race (i, structure, init) tasks on the budgets given by 
+    settings.halving_steps and halving_rows, keeping the best 
+    halving_keep fraction after each rung. Returns the surviving 
+    tasks and the indices of the candidates that were dropped. 
+    
+    Each rung continues from the parameters a candidate reached at the
+    previous one, and the surviving tasks carry the parameters they
+    reached at the last rung as their init, so their full runs build
+    on the racing budget rather than starting over. 
+    """
+    n_rungs = len(settings.halving_steps)
+    rows = settings.halving_rows if settings.halving_rows is not None else [None,] * n_rungs
+    
+    dropped = []
+    rung_init = {i: init for (i, s, init) in tasks}
+    for (n_steps, n_rows) in zip(settings.halving_steps, rows):
+        if len(tasks) <= 1:
+            break
+        
+        scores = {}
+        for i, (score, p) in run_tasks([(i, s, rung_init[i], (n_steps, n_rows)) for (i, s, init) in tasks],
+                                       X, settings, pool=pool):
+            scores[i] = score
+            if p is not None:
+                rung_init[i] = p
+
+        n_keep = max(1, int(np.ceil(len(tasks) * settings.halving_keep)))
+        ranked = sorted(tasks, key = lambda t : -scores[t[0]])
+        print("halving: %d steps on %s rows, keeping %d of %d" % (n_steps, n_rows if n_rows is not None else X.shape[0],
+                                                                  n_keep, len(tasks)))
+        dropped += [i for (i, s, init) in ranked[n_keep:]]
+        tasks = ranked[:n_keep]
+    return [(i, s, rung_init[i]) for (i, s, init) in tasks], dropped
+
+def score_and_sort_beam(beam, X, settings, pool=None, cache=None, warm_starts=None, trained=None):
+    """
+    Score each (structure, structure_logp, _) in the beam and return
+    the beam sorted by score. warm_starts optionally maps the 
+    canonical form of a structure to parameters to initialize it from;
+    the trained parameters of every structure scored here, or found
+    in the cache with its parameters, are stored into the dict 
+    trained, if given. 
+    """
+    
+    # look up every candidate we've already scored, in this search or
+    # an earlier one, and only score the first copy of each remaining
+    # structure (up to canonical form).
+    model_scores = {}
+    tasks = []
+    for (i, (structure, structure_logp, model_score)) in enumerate(beam):
+        key = canonical_form(structure)
+        if key in model_scores:
+            continue
+        cached = cache.get(structure) if cache is not None else None
+        if cached is None:
+            model_scores[key] = None
+            init = warm_starts.get(key) if warm_starts is not None else None
+            tasks.append((i, structure, init))
+        else:
+            model_scores[key], params = cached
+            if trained is not None and params is not None:
+                trained[key] = params
+    n_new = len(tasks)
+
+    # race the new candidates on small budgets, so that only the 
+    # promising ones are trained to convergence. Candidates dropped 
+    # this way score -inf for this round; they were never fully scored,
+    # so they aren't cached. 
+    if settings.halving_steps is not None:
+        tasks, dropped = successive_halving(tasks, X, settings, pool=pool)
+        for i in dropped:
+            model_scores[canonical_form(beam[i][0])] = -np.inf
+
+    def record(i, result):
+        model_score, params = result
+        structure = beam[i][0]
+        model_scores[canonical_form(structure)] = model_score
+        if trained is not None and params is not None:
+            trained[canonical_form(structure)] = params
+        # failures score -inf, but aren't cached
+        if cache is not None and np.isfinite(model_score):
+            cache.put(structure, model_score, params)
+            
+    for i, result in run_tasks([(i, s, init, None) for (i, s, init) in tasks], X, settings, pool=pool):
+        record(i, result)
+
     scored_beam = []
-    for (structure, structure_logp, model_score) in beam:
-        score = score_model(structure, X, settings) + structure_logp
+    for (structure, structure_logp, _) in beam:
+        score = model_scores[canonical_form(structure)] + structure_logp
         print("score", score, "for structure", structure)
         scored_beam.append((structure, structure_logp, score))
+    if n_new < len(beam):
+        print("scored %d of %d candidates, reused the rest" % (n_new, len(beam)))
     sorted_beam = sorted(scored_beam, key = lambda a : -a[2])
     return sorted_beam
 
-def expand_beam(beam, settings):
+def expand_beam(beam, settings, parents=None, lineage=None):
+    # if given, parents maps the canonical form of each new successor
+    # to the structure it was first expanded from, and lineage maps 
+    # the canonical form of each structure expanded in earlier rounds
+    # to that of its parent, so we can skip successors that simplify
+    # back to one of their ancestors (e.g. a double transpose).
     continue_logp = np.log(1.0-settings.p_stop_structure)
     new_beam = copy.copy(beam)
+    seen = set(canonical_form(s) for (s, _, _) in beam)
+    for key in list(seen):
+        while lineage is not None and key in lineage and lineage[key] not in seen:
+            key = lineage[key]
+            seen.add(key)
+    n_expansions = 0
+    n_pruned = 0
     for (structure, structure_score, model_score) in beam:
-        successors = list_successors(structure)
+        successors, n_dups = distinct_successors(structure)
+        # the structure prior spreads the parent's mass over all of 
+        # its productions, as in the unpruned grammar
+        n_productions = len(successors) + n_dups
+        n_expansions += n_productions
+        n_pruned += n_dups
         for successor in successors:
-            new_score = structure_score + continue_logp - np.log(len(successors))
+            # successors are in canonical form; skip any we already
+            # have from another parent, in the beam itself, or among
+            # the beam's ancestors
+            if successor in seen:
+                n_pruned += 1
+                continue
+            seen.add(successor)
+            
+            new_score = structure_score + continue_logp - np.log(n_productions)
             new_beam.append((successor, new_score, None))
+            if parents is not None:
+                parents.setdefault(successor, structure)
+    print("expanded beam: %d expansions, %d pruned as duplicates" % (n_expansions, n_pruned))
     return new_beam
             
 def do_structure_search(X, settings):
 
+    pool = make_pool(X, settings) if settings.n_workers is not None else None
+    # without a cache file, still memoize scores across rounds in memory
+    cache = ScoreCache(settings.score_cache or ":memory:", X, settings)
+
+    # trained parameters of the current beam, to warm-start successors
+    trained = {}
+    
     base_logprob = np.log(settings.p_stop_structure)
     structure_beam = [('g', base_logprob, 0.0),]
-    best_structures = score_and_sort_beam(structure_beam, X, settings)
+    best_structures = score_and_sort_beam(structure_beam, X, settings, pool=pool,
+                                          cache=cache, trained=trained)
     old_best_score = -np.inf
     best_score = best_structures[0][2]
 
+    # the canonical form of each structure's parent, over all rounds
+    lineage = {}
+    
     i = 0
     while best_score > old_best_score:
-        structure_beam = expand_beam(best_structures, settings)
-        scored_structures = score_and_sort_beam(structure_beam, X, settings)
+        parents = {}
+        structure_beam = expand_beam(best_structures, settings, parents=parents, lineage=lineage)
+        for (key, parent) in parents.items():
+            lineage.setdefault(key, canonical_form(parent))
+
+        warm_starts = None
+        if settings.warm_start:
+            warm_starts = {key: trained[canonical_form(parent)] for (key, parent) in parents.items()
+                           if canonical_form(parent) in trained}
+
+        round_trained = {}
+        scored_structures = score_and_sort_beam(structure_beam, X, settings, pool=pool, cache=cache,
+                                                warm_starts=warm_starts, trained=round_trained)
         best_structures = scored_structures[:settings.beamsize]
         old_best_score = best_score
         best_score = best_structures[0][2]
 
+        # keep parameters only for the survivors
+        trained.update(round_trained)
+        survivors = set(canonical_form(s) for (s, _, _) in best_structures)
+        trained = {k: v for (k, v) in trained.items() if k in survivors}
+        
         i+=1
         print("epoch %d" % i, "beam", best_structures)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+    cache.close()
+    return best_structures[0][0]
     
 def main():
     N = 50
@@ -120,6 +537,8 @@ def main():
     settings.gaussian_auto_ard = False
     settings.constant_gaussian_std = 1.0
     settings.constant_noise_std = 0.1
+    settings.n_workers = multiprocessing.cpu_count()
+    settings.score_cache = "search_scores.sqlite"
     
     #X = np.float32(np.random.randn(N, D))
 
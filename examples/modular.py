@@ -16,7 +16,7 @@ def gaussian_mean_model():
     mu = Gaussian(mean=0, std=10, shape=(1,), name="mu")
     X = Gaussian(mean=mu, std=1, shape=(100,), name="X")
 
-    sampled_X = X.sample(seed=0)
+    sampled_X = X.sample()
     X.observe(sampled_X)
 
     jm = Model(X)
@@ -29,7 +29,7 @@ def gaussian_lowrank_model():
     C = NoisyGaussianMatrixProduct(A=A, B=B, std=0.1, name="C")
 
 
-    sampled_C = C.sample(seed=0)
+    sampled_C = C.sample()
     C.observe(sampled_C)
 
     jm = Model(C)
@@ -40,7 +40,7 @@ def gaussian_randomwalk_model():
     A = Gaussian(mean=0.0, std=1.0, shape=(100, 2), name="A")
     C = NoisyCumulativeSum(A=A, std=0.1, name="C")
 
-    sampled_C = C.sample(seed=0)
+    sampled_C = C.sample()
     C.observe(sampled_C)
     jm = Model(C)
     
@@ -60,7 +60,7 @@ def clustering_gmm_model(n_clusters = 4,
     X = GMMClustering(weights=weights, centers=centers,
                       std=cluster_spread_std, shape=(n_points, dim), name="X")
 
-    sampled_X = X.sample(seed=0)
+    sampled_X = X.sample()
     X.observe(sampled_X)
 
     jm = Model(X)
@@ -78,7 +78,7 @@ def latent_feature_model():
     G = Gaussian(mean=0.0, std=1.0, shape=(K, D), name="G")
     D = NoisyLatentFeatures(B=B, G=G, std=0.1, name="D")
         
-    sampled_D = D.sample(seed=0)
+    sampled_D = D.sample()
     D.observe(sampled_D)
     jm = Model(D)
 
@@ -90,7 +90,7 @@ def sparsity():
     expG1 = UnaryTransform(G1, Exp, name="expG1")
     X = MultiplicativeGaussianNoise(expG1, 1.0, name="X")
 
-    sampled_X = X.sample(seed=0)
+    sampled_X = X.sample()
     X.observe(sampled_X)
 
     jm = Model(X)
@@ -118,42 +118,48 @@ def autoencoder():
     
     return jm
 
+def in_own_graph(build_model):
+    # each model lives in a fresh graph, so its memory is freed
+    # once we're done with it
+    with tf.Graph().as_default():
+        return build_model()
+
 def main():
 
 
     print("gaussian mean estimation")
-    model = gaussian_mean_model()
+    model = in_own_graph(gaussian_mean_model)
     posterior = model.train(steps=500)
     print(posterior)
 
     print("gaussian matrix factorization")
-    model = gaussian_lowrank_model()
+    model = in_own_graph(gaussian_lowrank_model)
     posterior = model.train(steps=500)
     print(posterior)
 
     print("gaussian random walk")
-    model = gaussian_randomwalk_model()
+    model = in_own_graph(gaussian_randomwalk_model)
     posterior = model.train(steps=1000)
     print(posterior)
     
     print("gaussian mixture model")
-    model = clustering_gmm_model()
+    model = in_own_graph(clustering_gmm_model)
     posterior = model.train(steps=1000)
     print(posterior)
 
 
     print("latent features")
-    model = latent_feature_model()
+    model = in_own_graph(latent_feature_model)
     posterior = model.train(steps=1000)
     print(posterior)
 
     print("bayesian sparsity")
-    model = sparsity()
+    model = in_own_graph(sparsity)
     posterior = model.train(steps=1000)
     print(posterior)
     
     print("variational autoencoder")
-    model = autoencoder()
+    model = in_own_graph(autoencoder)
     posterior = model.train(steps=1000, adam_rate=0.001)
     print(posterior)
     
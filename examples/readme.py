@@ -59,6 +59,10 @@ def custom_laplace():
     print("sampled mu was %.2f; posterior has loc %.2f and scale %.2f" % (sampled["mu"], posterior["q_mu"]["loc"], posterior["q_mu"]["scale"]))
 
 
-gaussian_mean_inference()
-custom_laplace()
+# each example builds its model in a fresh graph, so the first
+# model's memory is freed before the second is built
+with tf.Graph().as_default():
+    gaussian_mean_inference()
+with tf.Graph().as_default():
+    custom_laplace()
 
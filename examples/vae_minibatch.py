@@ -6,8 +6,6 @@ from elbow.elementary import Gaussian
 from elbow.joint_model import BatchGenerator
 from elbow.models.neural import neural_bernoulli, neural_gaussian
 
-from util import mnist_training_data
-
 import time
 
 def build_vae(d_z=2, d_hidden=256, d_x=784, N=100, total_N=60000):
@@ -26,17 +24,24 @@ def build_vae(d_z=2, d_hidden=256, d_x=784, N=100, total_N=60000):
     jm = Model(X, minibatch_ratio = total_N/float(N))
     return jm, x_placeholder
 
-def main():
-    Xtrain, _, _, _ = mnist_training_data()
+def main(data_path=None):
+    # data_path optionally names a .npy file of binarized images, one 
+    # per row, which is memory-mapped rather than loaded, so it can be
+    # larger than RAM. 
+    if data_path is None:
+        from util import mnist_training_data
+        Xtrain, _, _, _ = mnist_training_data()
+    else:
+        Xtrain = data_path
 
     batchsize = 100
-    jm, x_batch = build_vae(N=batchsize, total_N=Xtrain.shape[0])
-
     batches = BatchGenerator(Xtrain, batch_size=batchsize)
-    jm.register_feed(lambda : {x_batch: batches.next_batch()})
+    jm, x_batch = build_vae(N=batchsize, d_x=batches.data.shape[1], total_N=batches.n)
+    jm.register_feed(lambda : {x_batch: batches.next_batch()}, prefetch=4)
 
     jm.train(steps=10000, adam_rate=0.01)
     
 
 if __name__ == "__main__":
-    main()
+    import sys
+    main(*sys.argv[1:])
@@ -0,0 +1,60 @@
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+import numpy as np
+
+from elbow import Gaussian, Model
+
+
+def build_model(n):
+    with tf.Graph().as_default():
+        mu = Gaussian(mean=0.0, std=10.0, shape=(n, 2), name="mu")
+        X = Gaussian(mean=mu, std=1.0, shape=(n, 2), name="X")
+        X.observe(np.float32(np.ones((n, 2))))
+        return Model(X)
+
+def mean_key(values):
+    keys = [k for k in values if k.startswith("q_mu/mean")]
+    assert len(keys) == 1
+    return keys[0]
+
+def test_restore_into_grown_model_fills_leading_block():
+    small = build_model(3)
+    values = small.variational_values()
+    small.close()
+
+    large = build_model(5)
+    initial = large.variational_values()
+    key = mean_key(initial)
+    assert key in large.restore(values, verbose=False)
+    restored = large.variational_values()[key]
+    np.testing.assert_array_equal(restored[:3], values[key])
+    np.testing.assert_array_equal(restored[3:], initial[key][3:])
+    large.close()
+
+def test_restore_skips_arrays_larger_than_the_variable():
+    large = build_model(5)
+    values = large.variational_values()
+    large.close()
+
+    small = build_model(3)
+    initial = small.variational_values()
+    key = mean_key(initial)
+    assert key not in small.restore(values, verbose=False)
+    np.testing.assert_array_equal(small.variational_values()[key], initial[key])
+    small.close()
+
+def test_checkpoint_overwrites_existing_file(tmpdir):
+    path = str(tmpdir.join("checkpoint.npz"))
+    jm = build_model(3)
+    jm.save_checkpoint(path)
+    jm.train(steps=3, print_s=None)
+    jm.save_checkpoint(path)
+    trained = jm.variational_values()
+    jm.close()
+
+    restored = build_model(3)
+    restored.restore(path, verbose=False)
+    key = mean_key(trained)
+    np.testing.assert_array_equal(restored.variational_values()[key], trained[key])
+    restored.close()
@@ -0,0 +1,66 @@
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+import numpy as np
+
+from elbow import Gaussian, Model
+from elbow.models.factorizations import NoisyGaussianMatrixProduct, NoisySparseGaussianMatrixProduct
+
+
+def minibatch_model(batch_size, **kwargs):
+    with tf.Graph().as_default():
+        A = Gaussian(mean=0.0, std=1.0, shape=(20, 3), name="A")
+        B = Gaussian(mean=0.0, std=1.0, shape=(10, 3), name="B")
+        R = NoisySparseGaussianMatrixProduct(A=A, B=B, std=0.1, batch_size=batch_size, name="R", **kwargs)
+    return R, Model(R)
+
+def observed_entries(n, seed=0):
+    rng = np.random.RandomState(seed)
+    return rng.randint(20, size=n), rng.randint(10, size=n), np.float32(rng.randn(n))
+
+def test_minibatch_scale_cant_change_after_the_elbo_is_built():
+    rows, cols, values = observed_entries(200)
+    R, jm = minibatch_model(50)
+    jm.register_feed(R.observe_minibatches(rows, cols, values))
+    jm.train(steps=2, print_s=None)
+    assert R.scale_logp == 4.0
+
+    with pytest.raises(Exception, match="already built"):
+        R.observe_minibatches(rows[:100], cols[:100], values[:100])
+    jm.close()
+
+def test_minibatch_scale_from_constructor():
+    rows, cols, values = observed_entries(200)
+    R, jm = minibatch_model(50, n_observed=200)
+    assert R.scale_logp == 4.0
+    jm.register_feed(R.observe_minibatches(rows, cols, values))
+    elbo, elp, entropy = jm.train(steps=2, print_s=None)
+    assert np.isfinite(elbo)
+    jm.close()
+
+def product_expected_logp(X, std, observe="constant", mask=None, seed=0):
+    rng = np.random.RandomState(seed)
+    N, M = X.shape
+    with tf.Graph().as_default():
+        q_A = Gaussian(mean=np.float32(rng.randn(N, 3)), std=np.float32(rng.rand(N, 3) + 0.1), name="q_A")
+        q_B = Gaussian(mean=np.float32(rng.randn(M, 3)), std=np.float32(rng.rand(M, 3) + 0.1), name="q_B")
+        R = NoisyGaussianMatrixProduct(A=q_A, B=q_B, std=std, mask=mask, name="R")
+        feed = {}
+        if observe == "constant":
+            R.observe(X)
+        else:
+            feed[R.observe_placeholder()] = X
+        lp = R._expected_logp(R.q_distribution(), q_A=q_A, q_B=q_B)
+        with tf.Session() as sess:
+            return sess.run(lp, feed_dict=feed)
+
+@pytest.mark.parametrize("std_shape", [(1, 1), (8, 1), (1, 5)])
+def test_factored_expected_logp_matches_dense(std_shape):
+    rng = np.random.RandomState(1)
+    X = np.float32(rng.randn(8, 5))
+    std = np.float32(rng.rand(*std_shape) + 0.5)
+
+    # an all-ones mask takes the dense path
+    dense = product_expected_logp(X, std, mask=np.ones(X.shape, dtype=np.float32))
+    np.testing.assert_allclose(product_expected_logp(X, std), dense, rtol=1e-5)
+    np.testing.assert_allclose(product_expected_logp(X, std, observe="placeholder"), dense, rtol=1e-5)
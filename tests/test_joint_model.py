@@ -0,0 +1,134 @@
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+import numpy as np
+
+from elbow import Gaussian, Model
+from elbow.joint_model import PrefetchingFeeder
+
+
+def build_model(seed=0, **model_kwargs):
+    # each model gets its own graph, seeded the same way, so two models
+    # built by this function draw the same random numbers step by step.
+    np.random.seed(seed)
+    with tf.Graph().as_default():
+        tf.set_random_seed(seed)
+        mu = Gaussian(mean=0.0, std=10.0, shape=(1,), name="mu")
+        X = Gaussian(mean=mu, std=1.0, shape=(20,), name="X")
+        X.observe(np.float32(np.linspace(-1, 3, 20)))
+        return Model(X, **model_kwargs)
+
+def assert_same_posterior(a, b):
+    assert sorted(a.keys()) == sorted(b.keys())
+    for node_name in a:
+        for name in a[node_name]:
+            np.testing.assert_allclose(a[node_name][name], b[node_name][name], rtol=1e-5, atol=1e-6)
+
+def test_block_steps_match_separate_train_steps():
+    n_steps = 10
+
+    separate = build_model()
+    for i in range(n_steps):
+        separate.train(steps=1, print_s=None)
+
+    blocked = build_model()
+    blocked.train(steps=n_steps, steps_per_check=n_steps, print_s=None)
+
+    assert_same_posterior(separate.posterior(), blocked.posterior())
+    # the whole block ran as a single in-graph loop
+    assert blocked._train_loops[0.99] is not None
+    separate.close()
+    blocked.close()
+
+@pytest.mark.parametrize("n_steps", [5, 25])
+def test_partial_blocks_take_the_requested_steps(n_steps):
+    separate = build_model()
+    for i in range(n_steps):
+        separate.train(steps=1, print_s=None)
+
+    blocked = build_model()
+    elbo, elp, entropy = blocked.train(steps=n_steps, steps_per_check=10, print_s=None)
+    assert np.isfinite(elbo)
+
+    assert_same_posterior(separate.posterior(), blocked.posterior())
+    separate.close()
+    blocked.close()
+
+def test_looped_and_separate_steps_share_adam_state():
+    separate = build_model()
+    for i in range(12):
+        separate.train(steps=1, print_s=None)
+
+    mixed = build_model()
+    mixed.train(steps=3, print_s=None)
+    mixed.train(steps=9, steps_per_check=4, print_s=None)
+
+    assert_same_posterior(separate.posterior(), mixed.posterior())
+    separate.close()
+    mixed.close()
+
+def test_stale_parameters_fall_back_to_separate_steps():
+    # a bonus term computed outside the loop would be stuck at its
+    # value from before the block
+    jm = build_model()
+    with jm.graph.as_default():
+        scale = tf.Variable(1.0, name="scale")
+        jm.add_elbo_term(-tf.square(scale))
+    jm.train(steps=4, steps_per_check=2, print_s=None)
+    assert jm._train_loops[0.99] is None
+    jm.close()
+
+def test_debug_training_with_particles():
+    # the particle draws are taken in a while loop, which 
+    # tf.add_check_numerics_ops would reject
+    jm = build_model(n_particles=2)
+    elbo, elp, entropy = jm.train(steps=5, debug=True, print_s=None)
+    assert np.isfinite(elbo)
+
+    jm.train(steps=4, steps_per_check=2, debug=True, print_s=None)
+    jm.close()
+
+def test_models_sharing_a_graph_only_initialize_their_own_variables():
+    first = build_model()
+    first.train(steps=2, print_s=None)
+    with first.graph.as_default():
+        nu = Gaussian(mean=0.0, std=10.0, shape=(1,), name="nu")
+        Y = Gaussian(mean=nu, std=1.0, shape=(5,), name="Y")
+        Y.observe(np.float32(np.ones(5)))
+    second = Model(Y)
+    second.train(steps=2, print_s=None)
+
+    first_vars = set(first.model_variables())
+    second_vars = set(second.model_variables())
+    assert len(first_vars) > 0 and len(second_vars) > 0
+    assert first_vars.isdisjoint(second_vars)
+    with second.graph.as_default():
+        uninitialized = second.get_session().run(tf.report_uninitialized_variables())
+    assert set(v.op.name.encode() for v in first_vars) <= set(uninitialized)
+    first.close()
+    second.close()
+
+def test_sample_accepts_deprecated_seed():
+    with tf.Graph().as_default():
+        mu = Gaussian(mean=0.0, std=10.0, shape=(3,), name="mu")
+    with pytest.warns(DeprecationWarning):
+        assert mu.sample(seed=0).shape == (3,)
+    assert mu.sample().shape == (3,)
+
+def test_prefetching_feeder_keeps_raising_after_an_error():
+    n_calls = [0]
+    def feeder():
+        n_calls[0] += 1
+        if n_calls[0] > 2:
+            raise ValueError("out of data")
+        return {"batch": np.ones(3) * n_calls[0]}
+
+    prefetcher = PrefetchingFeeder(feeder, capacity=1, n_threads=2)
+    with pytest.raises(ValueError):
+        for i in range(3):
+            prefetcher()
+    # later calls (e.g. from a retried train()) raise instead of blocking
+    with pytest.raises(ValueError):
+        prefetcher()
+    prefetcher.close()
+    assert not any(thread.is_alive() for thread in prefetcher.threads)
@@ -0,0 +1,71 @@
+import gc
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+import numpy as np
+
+from elbow import Gaussian, BetaMatrix, Model
+from elbow.replicated import ReplicatedModel
+
+R, N = 3, 10
+
+def replica_data(seed=0):
+    rng = np.random.RandomState(seed)
+    return np.float32(rng.randn(R, N) + np.arange(R)[:, None])
+
+def build_replicated(data, q_mean=None, q_std=None):
+    with tf.Graph().as_default():
+        mu = Gaussian(mean=0.0, std=10.0, shape=(R, 1), name="mu", replicated=True)
+        X = Gaussian(mean=mu, std=1.0, shape=(R, N), name="X", replicated=True)
+        X.observe(data)
+        if q_mean is not None:
+            mu.attach_q(Gaussian(mean=q_mean, std=q_std, shape=(R, 1), name="q_mu", replicated=True))
+    return X
+
+def build_single(data, q_mean, q_std):
+    with tf.Graph().as_default():
+        mu = Gaussian(mean=0.0, std=10.0, shape=(1, 1), name="mu")
+        X = Gaussian(mean=mu, std=1.0, shape=(1, N), name="X")
+        X.observe(data)
+        mu.attach_q(Gaussian(mean=q_mean, std=q_std, shape=(1, 1), name="q_mu"))
+    return X
+
+def test_replica_elbos_match_single_models():
+    data = replica_data()
+    q_mean = np.float32([[0.5], [1.0], [2.0]])
+    q_std = np.float32([[0.3], [0.2], [0.5]])
+
+    jm = Model(build_replicated(data, q_mean, q_std))
+    replica_elbos = jm.get_session().run(jm.replica_elbos())
+    total_elbo = jm.get_session().run(jm.construct_elbo())
+    jm.close()
+
+    assert replica_elbos.shape == (R,)
+    np.testing.assert_allclose(total_elbo, np.sum(replica_elbos), rtol=1e-5)
+    for r in range(R):
+        single = Model(build_single(data[r:r+1], q_mean[r:r+1], q_std[r:r+1]))
+        single_elbo = single.get_session().run(single.construct_elbo())
+        single.close()
+        np.testing.assert_allclose(replica_elbos[r], single_elbo, rtol=1e-5)
+
+def test_replicated_model_trains_each_replica():
+    np.random.seed(0)
+    rm = ReplicatedModel(build_replicated(replica_data()))
+    final_elbos = rm.train(steps=20, print_s=None)
+
+    assert len(final_elbos) == R
+    assert all(np.isfinite(final_elbos))
+    for r in range(R):
+        assert len(rm.traces[r]) == 20
+        assert rm.posterior(r)["q_mu"]["mean"].shape == (1,)
+    rm.close()
+
+def test_unsupported_replicated_node_raises(capsys):
+    with tf.Graph().as_default():
+        B = BetaMatrix(alpha=1.0, beta=1.0, shape=(R, 2), name="B", replicated=True)
+        with pytest.raises(Exception, match="does not support replication"):
+            Model(B)
+
+    # the half-built model is closed cleanly when it's collected
+    gc.collect()
+    assert "Exception ignored" not in capsys.readouterr().err